@@ -1,18 +1,118 @@
-from sqlalchemy.sql.expression import func, cast
+import json
+
+from sqlalchemy.sql.expression import func, cast, case, or_, true, bindparam, select
 from sqlalchemy.types import Numeric
-from shapely.geometry import shape, mapping, Point
+from sqlalchemy.orm import defer, aliased
+from sqlalchemy.ext import baked
+from shapely.geometry import shape, mapping
 
 from sqlalchemy.sql.expression import func, cast
 from geoalchemy2 import Geography
-from geoalchemy2.shape import to_shape, from_shape
+from geoalchemy2.shape import to_shape
 
 from idb.models import Species, Inventory, Interpreted, Studyarea
-from idb.models import Trainwindow, Experiment
+from idb.models import Trainwindow, Experiment, Progress
+from idb import stats
 
 __version__ = '0.2.1'
 
+# Cache of the compiled filter queries (see _inventories), keyed on the steps
+# used to build them. Filter values are bound parameters
+bakery = baked.bakery()
+
+# Untyped geography, casts then match the (geom::geography) expression indexes
+GEOGRAPHY = Geography(geometry_type=None)
+
+
+def _geom_expression(geom, precision=None, tolerance=None, geom_format='geojson',
+                     grid=None, dialect=None):
+    """Build the sql expression returning a geometry in the requested output form
 
-def add_inventories(session, fc):
+    Returns None when no output option is set, in which case the geometry column
+    is loaded as is and converted to geojson in python. ``grid`` optionally
+    replaces the snapping grid size derived from ``precision`` (wkb output).
+    ``dialect`` is the name of the database dialect (spatialite has no
+    ST_AsGeoJSON, only AsGeoJSON)
+    """
+    if precision is None and tolerance is None and geom_format == 'geojson':
+        return None
+    if tolerance is not None:
+        geom = func.ST_SimplifyPreserveTopology(geom, tolerance)
+    if geom_format == 'geojson':
+        as_geojson = func.AsGeoJSON if dialect == 'sqlite' else func.ST_AsGeoJSON
+        return as_geojson(geom, precision if precision is not None else 15)
+    if geom_format == 'wkb':
+        if precision is not None:
+            geom = func.ST_SnapToGrid(geom, grid if grid is not None else 10 ** -precision)
+        return func.ST_AsBinary(geom)
+    raise ValueError('Unknown geom_format: %s' % geom_format)
+
+
+def _geometry(value, geom_format='geojson'):
+    """Convert a geometry returned by the database to its output form"""
+    if geom_format == 'wkb':
+        return bytes(value)
+    if isinstance(value, str):
+        return json.loads(value)
+    return mapping(to_shape(value))
+
+
+def _features(objects, model, precision=None, tolerance=None,
+              geom_format='geojson'):
+    """Run a query on a model and return a list of features
+
+    The geometry column is not loaded when output options are set, the
+    geometry is instead computed and encoded by the database
+    """
+    geom = _geom_expression(model.geom, precision=precision, tolerance=tolerance,
+                            geom_format=geom_format,
+                            dialect=objects.session.get_bind().dialect.name)
+    if geom is None:
+        return [x.geojson for x in objects]
+    objects = objects.options(defer(model.geom)).add_columns(geom.label('geom_out'))
+    return [{'type': 'Feature',
+             'properties': obj.properties,
+             'geometry': _geometry(geom_out, geom_format)}
+            for obj, geom_out in objects]
+
+
+def _baked_features(session, bq, params, model, precision=None, tolerance=None,
+                    geom_format='geojson'):
+    """Run a baked query on a model and return a list of features
+
+    Same as ``_features``; output options are bound parameters, the statement is
+    cached once per combination of options set
+    """
+    if precision is None and tolerance is None and geom_format == 'geojson':
+        return [x.geojson for x in bq(session).params(**params)]
+    dialect = session.get_bind().dialect.name
+    def add_geom(q):
+        geom = _geom_expression(model.geom,
+                                precision=None if precision is None else bindparam('geom_precision'),
+                                tolerance=None if tolerance is None else bindparam('geom_tolerance'),
+                                geom_format=geom_format,
+                                grid=bindparam('geom_grid'),
+                                dialect=dialect)
+        return q.options(defer(model.geom)).add_columns(geom.label('geom_out'))
+    bq = bq.with_criteria(add_geom, model, precision is None, tolerance is None,
+                          geom_format, dialect)
+    params = dict(params, geom_precision=precision, geom_tolerance=tolerance,
+                  geom_grid=None if precision is None else 10 ** -precision)
+    return [{'type': 'Feature',
+             'properties': obj.properties,
+             'geometry': _geometry(geom_out, geom_format)}
+            for obj, geom_out in bq(session).params(**params)]
+
+
+def _within_radius(geom):
+    """Clause keeping geometries within ``radius`` meters of the (``lon``, ``lat``)
+    point, all three being bound parameters"""
+    point = func.ST_SetSRID(func.ST_MakePoint(bindparam('lon'), bindparam('lat')), 4326)
+    return func.ST_DWithin(cast(geom, GEOGRAPHY), cast(point, GEOGRAPHY),
+                           bindparam('radius'))
+
+
+def add_inventories(session, fc, species_ids=None, tile_ids=None):
     """Add one or many inventory records to the database
 
     Table Species must already contain all species, see db_init.py command line
@@ -21,20 +121,141 @@ def add_inventories(session, fc):
     Args:
         session (Session): sqlalchemy database session
         fc (list): Feature collection (list of geojson features)
+        species_ids (dict): Optional mapping of species codes to species ids,
+            avoids one species lookup per feature (see ``idb.ingest.lookups``)
+        tile_ids (dict): Optional mapping of tile names to tile ids. Must be
+            provided together with species_ids
     """
     if not isinstance(fc, list):
         fc = [fc]
-    instance_list = [Inventory.from_geojson(feature=x, session=session)
+    instance_list = [Inventory.from_geojson(feature=x, session=session,
+                                            species_ids=species_ids,
+                                            tile_ids=tile_ids)
                      for x in fc]
-    session.add_all(instance_list)
+    # Spatially close records are stored close to each other
+    instance_list.sort(key=lambda x: x.hilbert)
+    with stats.tracking(session) as ids:
+        session.add_all(instance_list)
+        session.flush()
+        ids.update(x.id for x in instance_list)
 
 
-def _inventories(session, n_samples=None, study_area_id=None, species_id=None,
-                 is_interpreted=False, spatial_filter=None):
-    """Build a Query to filter the Inventory table
+def _upsert_statement(session):
+    """Build an INSERT ... ON CONFLICT statement on the inventory natural key
+
+    On conflict, only the inventory attributes are updated (``is_interpreted``
+    and ``comment`` are kept), and only when at least one of them changed
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = Inventory.__table__
+    stmt = insert(table)
+    columns = ['geom', 'species_id', 'quality', 'dbh']
+    changed = or_(*[table.c[c].is_distinct_from(stmt.excluded[c])
+                    for c in columns])
+    set_ = {c: stmt.excluded[c] for c in columns + ['hilbert']}
+    set_['time_updated'] = func.now()
+    return stmt.on_conflict_do_update(index_elements=['tile_id', 'exp_num'],
+                                      set_=set_, where=changed)
+
+
+def upsert_inventories(session, fc, species_ids=None, tile_ids=None):
+    """Insert or update inventory records, keyed on (tile, exploitation number)
+
+    Re-ingesting a corrected inventory updates the attributes (geometry,
+    species, quality, dbh) of the records that changed and inserts the new ones.
+    ``is_interpreted``, ``comment`` and the linked Interpreted rows of existing
+    records are kept. Unchanged records are detected beforehand and not written,
+    so that the cost of a re-ingest is driven by the number of changes
+
+    Requires the ``uq_inventory_tile_id_exp_num`` unique index (see db_init.py)
+    and, for sqlite, sqlalchemy >= 1.4
+
+    Args:
+        session (Session): sqlalchemy database session
+        fc (list): Feature collection (list of geojson features), see
+            ``idb.add_inventories``
+        species_ids (dict): Optional mapping of species codes to species ids
+        tile_ids (dict): Optional mapping of tile names to tile ids. Both
+            mappings are built (and missing tiles created) when not provided
+
+    Returns:
+        dict: Number of records ``inserted``, ``updated`` and ``unchanged``
+    """
+    if not isinstance(fc, list):
+        fc = [fc]
+    # Existing records are compared with the batch, read them from the primary
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    if species_ids is None or tile_ids is None:
+        from idb.ingest import lookups
+        species_ids, tile_ids = lookups(session, {x['properties']['PLACETTE']
+                                                  for x in fc})
+    # Last occurrence wins when a key is duplicated within the collection
+    instances = {}
+    for feature in fc:
+        obj = Inventory.from_geojson(feature=feature, session=session,
+                                     species_ids=species_ids, tile_ids=tile_ids)
+        instances[(obj.tile_id, obj.exp_num)] = obj
+    if not instances:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    def existing_rows(keys, *columns):
+        # Sorted keys read in chunks, keeps the IN lists bounded and the chunks
+        # compact (few tiles per chunk)
+        keys = sorted(keys)
+        rows = {}
+        for i in range(0, len(keys), stats.CHUNK_SIZE):
+            chunk = keys[i:i + stats.CHUNK_SIZE]
+            q = session.query(Inventory.tile_id, Inventory.exp_num, *columns)\
+                    .filter(Inventory.tile_id.in_({k[0] for k in chunk}),
+                            Inventory.exp_num.in_({k[1] for k in chunk}))
+            rows.update(((x[0], x[1]), x) for x in q if (x[0], x[1]) in instances)
+        return rows
+
+    existing = existing_rows(instances, Inventory.id, Inventory.species_id,
+                             Inventory.quality, Inventory.dbh, Inventory.geom)
+    changed = []
+    for key, obj in instances.items():
+        old = existing.get(key)
+        if old is None\
+                or (old.species_id, old.quality, old.dbh) != (obj.species_id, obj.quality, obj.dbh)\
+                or not to_shape(old.geom).equals(to_shape(obj.geom)):
+            changed.append(obj)
+    changed_keys = {(x.tile_id, x.exp_num) for x in changed}
+    # New records are inserted in Hilbert order (see add_inventories)
+    changed.sort(key=lambda x: x.hilbert)
+    if changed:
+        with stats.tracking(session, [existing[k].id for k in changed_keys
+                                      if k in existing]) as ids:
+            session.execute(_upsert_statement(session),
+                            [{'geom': x.geom,
+                              'species_id': x.species_id,
+                              'tile_id': x.tile_id,
+                              'exp_num': x.exp_num,
+                              'quality': x.quality,
+                              'dbh': x.dbh,
+                              'hilbert': x.hilbert,
+                              'is_interpreted': False} for x in changed])
+            # Ids of the inserted records, updated ones are already known
+            ids.update(x.id for x in existing_rows(changed_keys - set(existing),
+                                                   Inventory.id).values())
+    n_updated = len(changed_keys & set(existing))
+    return {'inserted': len(changed) - n_updated,
+            'updated': n_updated,
+            'unchanged': len(instances) - len(changed)}
+
+
+def _inventories(n_samples=None, study_area_id=None, species_id=None,
+                 is_interpreted=False, spatial_filter=None, shuffle=True):
+    """Build a cached query to filter the Inventory table
+
+    Filter values are passed as bound parameters, so that the statement is
+    compiled once per combination of filters used and reused by later calls
 
     Args:
-        session: A database session (see idb.db.session_scope)
         n_samples (int): Number of samples (no limit if None (default))
         study_area_id (int): Optinal Studyarea id
         species_id (int): Optional Species id
@@ -43,39 +264,51 @@ def _inventories(session, n_samples=None, study_area_id=None, species_id=None,
             Can also be None, in which case all interpreted and not interpreted
             records are returned
         spatial_filter (dict): A spatial filtering dictionnary. Must contain the
-            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. A circle 
-            is buils using these paramters and only interpreted features that spatially
-            intersect with the circle are returned.
+            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. Only
+            features within that distance of the point are returned.
+        shuffle (bool): Return the rows in random order (default)
 
     Returns:
-        sqlalchemy.Query: The sqlalchemy query
+        tuple: The sqlalchemy baked query and a dict of its parameters
     """
-    objects = session.query(Inventory)
-    # is_interpreted filter (default is False)
+    bq = bakery(lambda session: session.query(Inventory))
+    params = {}
+    # is_interpreted filter (default is False), kept literal so that the partial
+    # index on records not yet interpreted remains usable
     if is_interpreted is not None:
-        objects = objects.filter(Inventory.is_interpreted.is_(is_interpreted))
-    # Study area filter (st_intersects)
+        if is_interpreted:
+            bq += lambda q: q.filter(Inventory.is_interpreted.is_(True))
+        else:
+            bq += lambda q: q.filter(Inventory.is_interpreted.is_(False))
+    # Study area filter (st_intersects with the study area geometry, fetched by
+    # a subquery)
     if study_area_id is not None:
-        study_area_geom = session.query(Studyarea)\
-                .filter_by(id=study_area_id)\
-                .first()\
-                .geom
-        objects = objects.filter(Inventory.geom.ST_Intersects(study_area_geom))
+        bq += lambda q: q.filter(func.ST_Intersects(
+            Inventory.geom,
+            select([Studyarea.geom])\
+                    .where(Studyarea.id == bindparam('study_area_id'))\
+                    .as_scalar()))
+        params['study_area_id'] = study_area_id
     # Restrict for only one species
     if species_id is not None:
-        objects = objects.filter_by(species_id=species_id)
+        bq += lambda q: q.filter(Inventory.species_id == bindparam('species_id'))
+        params['species_id'] = species_id
     if spatial_filter is not None:
-        p = Point(spatial_filter['lon'], spatial_filter['lat'])
-        geog = cast(from_shape(p, srid=4326), Geography)
-        circle = geog.ST_Buffer(spatial_filter['radius'])
-        objects = objects.filter(Inventory.geom.ST_Intersects(circle))
+        bq += lambda q: q.filter(_within_radius(Inventory.geom))
+        params.update(lon=spatial_filter['lon'], lat=spatial_filter['lat'],
+                      radius=spatial_filter['radius'])
     # Select n random samples from the remaining rows
-    objects = objects.order_by(func.random()).limit(n_samples)
-    return objects
+    if shuffle:
+        bq += lambda q: q.order_by(func.random())
+    if n_samples is not None:
+        bq += lambda q: q.limit(bindparam('n_samples'))
+        params['n_samples'] = n_samples
+    return bq, params
 
 
 def inventories(session, n_samples=None, study_area_id=None, species_id=None,
-                is_interpreted=False, spatial_filter=None):
+                is_interpreted=False, spatial_filter=None, precision=None,
+                tolerance=None, geom_format='geojson'):
     """Query the Inventory table with optional filters
 
     Only returns samples with ``is_interpreted`` set to False
@@ -90,19 +323,81 @@ def inventories(session, n_samples=None, study_area_id=None, species_id=None,
             Can also be None, in which case all interpreted and not interpreted
             records are returned
         spatial_filter (dict): A spatial filtering dictionnary. Must contain the
-            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. A circle 
-            is buils using these paramters and only interpreted features that spatially
-            intersect with the circle are returned.
+            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. Only
+            features within that distance of the point are returned.
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
 
     Returns:
         dict: A feature collection
     """
-    objects = _inventories(session=session, n_samples=n_samples,
-                           study_area_id=study_area_id, species_id=species_id,
-                           is_interpreted=is_interpreted,
-                           spatial_filter=spatial_filter)
+    bq, params = _inventories(n_samples=n_samples, study_area_id=study_area_id,
+                              species_id=species_id, is_interpreted=is_interpreted,
+                              spatial_filter=spatial_filter)
     return {'type': 'FeatureCollection',
-            'features': [x.geojson for x in objects.all()]}
+            'features': _baked_features(session, bq, params, Inventory,
+                                        precision=precision, tolerance=tolerance,
+                                        geom_format=geom_format)}
+
+
+def stratified_inventories(session, quotas, by='species_id', study_area_id=None,
+                           is_interpreted=False, spatial_filter=None,
+                           precision=None, tolerance=None, geom_format='geojson'):
+    """Draw a balanced random sample of the Inventory table in a single query
+
+    Records are randomly ranked within each stratum (window function) and the
+    first ``quota`` records of every stratum are returned
+
+    Args:
+        session: A database session (see idb.db.session_scope)
+        quotas (dict): Number of samples to draw per stratum, e.g.
+            ``{species_id: n_samples}``. Strata absent from the dict are ignored
+        by (str): Column defining the strata, either ``'species_id'`` (default)
+            or ``'tile_id'``
+        study_area_id (int): Optinal Studyarea id
+        is_interpreted (bool): Filter on ``is_interpreted`` field,
+            defaults to False (keep only records that have not yet been interpreted)
+            Can also be None, in which case all interpreted and not interpreted
+            records are returned
+        spatial_filter (dict): A spatial filtering dictionnary. Must contain the
+            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. Only
+            features within that distance of the point are returned.
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
+
+    Returns:
+        dict: A feature collection
+    """
+    column = {'species_id': Inventory.species_id,
+              'tile_id': Inventory.tile_id}[by]
+    if not quotas:
+        return {'type': 'FeatureCollection', 'features': []}
+    # Filtered inventory, without the global random sort
+    bq, params = _inventories(study_area_id=study_area_id,
+                              is_interpreted=is_interpreted,
+                              spatial_filter=spatial_filter, shuffle=False)
+    filtered = bq.to_query(session).filter(column.in_(list(quotas)))
+    rank = func.row_number().over(partition_by=column, order_by=func.random())
+    sq = filtered.with_entities(Inventory.id.label('id'),
+                                column.label('stratum'),
+                                rank.label('rank')).subquery()
+    quota = case(quotas, value=sq.c.stratum, else_=0)
+    objects = session.query(Inventory)\
+            .join(sq, sq.c.id == Inventory.id)\
+            .filter(sq.c.rank <= quota)\
+            .order_by(sq.c.stratum, sq.c.rank)\
+            .params(**params)
+    return {'type': 'FeatureCollection',
+            'features': _features(objects, Inventory, precision=precision,
+                                  tolerance=tolerance, geom_format=geom_format)}
 
 
 def inventories_hits(session, n_samples=None, study_area_id=None, species_id=None,
@@ -122,27 +417,28 @@ def inventories_hits(session, n_samples=None, study_area_id=None, species_id=Non
             Can also be None, in which case all interpreted and not interpreted
             records are returned
         spatial_filter (dict): A spatial filtering dictionnary. Must contain the
-            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. A circle 
-            is buils using these paramters and only interpreted features that spatially
-            intersect with the circle are returned.
+            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. Only
+            features within that distance of the point are returned.
 
     Returns:
         int: The length of rows queried
     """
-    objects = _inventories(session=session, n_samples=n_samples,
-                           study_area_id=study_area_id, species_id=species_id,
-                           is_interpreted=is_interpreted,
-                           spatial_filter=spatial_filter)
-    return objects.count()
+    bq, params = _inventories(n_samples=n_samples, study_area_id=study_area_id,
+                              species_id=species_id, is_interpreted=is_interpreted,
+                              spatial_filter=spatial_filter, shuffle=False)
+    return bq(session).params(**params).count()
 
 
-def inventory(session, id):
+def inventory(session, id, precision=None, tolerance=None,
+              geom_format='geojson'):
     """Get a single inventory record by id
+
+    See ``idb.inventories`` for the geometry output arguments
     """
-    obj = session.query(Inventory).get(id)
-    if obj is not None:
-        obj = obj.geojson
-    return obj
+    objects = session.query(Inventory).filter(Inventory.id == id)
+    features = _features(objects, Inventory, precision=precision,
+                         tolerance=tolerance, geom_format=geom_format)
+    return features[0] if features else None
 
 
 def update_inventory(session, id, is_interpreted=None, comment=None):
@@ -159,9 +455,10 @@ def update_inventory(session, id, is_interpreted=None, comment=None):
                      'comment': comment}
     # Remove None to avoid overriding existing values
     update_dict_1 = {k:v for k,v in update_dict_0.items() if v is not None}
-    updated = session.query(Inventory)\
-            .filter_by(id=id)\
-            .update(update_dict_1)
+    with stats.tracking(session, [id]):
+        updated = session.query(Inventory)\
+                .filter_by(id=id)\
+                .update(update_dict_1)
     return updated
 
 
@@ -180,8 +477,8 @@ def add_interpreted(session, fc):
         fc = [fc]
     instance_list = [Interpreted.from_geojson(feature=x)
                      for x in fc]
-    session.add_all(instance_list)
-    session.flush()
+    with stats.tracking(session, [x.inventory_id for x in instance_list]):
+        session.add_all(instance_list)
     return [x.geojson for x in instance_list]
 
 
@@ -204,13 +501,66 @@ def replace_interpreted(session, id, feature):
     # Create an instance of Interpreted
     new_row = Interpreted.from_geojson(feature)
     new_row.id = id
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    old_row = session.query(Interpreted).get(id)
+    # Both the previous and the new inventory records change their polygon count
+    affected = [new_row.inventory_id]
+    if old_row is not None:
+        affected.append(old_row.inventory_id)
     # Update by merging
-    session.merge(new_row)
+    with stats.tracking(session, affected):
+        session.merge(new_row)
     return True
 
 
+def progress(session, study_area_id=None, species_id=None, tile_id=None,
+             group_by=('species_id',)):
+    """Get interpretation progress statistics
+
+    Reads the incrementally maintained ``progress`` table instead of scanning the
+    inventory (see ``idb.stats``; rebuild it with ``rebuild_progress.py``)
+
+    Args:
+        session: sqlalchemy database session
+        study_area_id (int): Optional Studyarea id. When None, statistics cover
+            the full inventory
+        species_id (int): Optional Species id
+        tile_id (int): Optional Tile id
+        group_by (list): Any combination of ``'species_id'``, ``'tile_id'`` and
+            ``'study_area_id'``. Grouping by ``'study_area_id'`` only counts
+            records located in a study area. Use an empty list to get global
+            totals
+
+    Return:
+        list: List of dict with the group_by keys and the ``total``,
+            ``interpreted`` and ``interpreted_polygons`` counts
+    """
+    columns = {'species_id': Progress.species_id,
+               'tile_id': Progress.tile_id,
+               'study_area_id': Progress.studyarea_id}
+    keys = [columns[k] for k in group_by]
+    objects = session.query(*keys,
+                            func.coalesce(func.sum(Progress.total), 0),
+                            func.coalesce(func.sum(Progress.interpreted), 0),
+                            func.coalesce(func.sum(Progress.interpreted_polygons), 0))
+    if 'study_area_id' in group_by:
+        objects = objects.filter(Progress.studyarea_id.isnot(None))
+    # Null studyarea_id rows hold the whole tile totals
+    if study_area_id is not None or 'study_area_id' not in group_by:
+        objects = objects.filter(Progress.studyarea_id == study_area_id)
+    if species_id is not None:
+        objects = objects.filter(Progress.species_id == species_id)
+    if tile_id is not None:
+        objects = objects.filter(Progress.tile_id == tile_id)
+    objects = objects.group_by(*keys).order_by(*keys)
+    names = list(group_by) + ['total', 'interpreted', 'interpreted_polygons']
+    return [dict(zip(names, row)) for row in objects]
+
+
 def interpreted(session, n_samples=None, species_id=None, inventory_id=None,
-                spatial_filter=None):
+                spatial_filter=None, precision=None, tolerance=None,
+                geom_format='geojson'):
     """Return a list of all interpreted records registered in the database
 
     Args:
@@ -220,36 +570,50 @@ def interpreted(session, n_samples=None, species_id=None, inventory_id=None,
         inventory_id (int): Optional inventory_id filter (returns a list of max
             one element)
         spatial_filter (dict): A spatial filtering dictionnary. Must contain the
-            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. A circle 
-            is buils using these paramters and only interpreted features that spatially
-            intersect with the circle are returned.
+            keys ``lon``, ``lat`` and ``radius``. Radius is in meters. Only
+            features within that distance of the point are returned.
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
 
     Return:
         dict: A feature collection
     """
-    objects = session.query(Interpreted)
+    bq = bakery(lambda session: session.query(Interpreted))
+    params = {}
     if species_id is not None:
-        objects = objects.filter_by(species_id=species_id)
+        bq += lambda q: q.filter(Interpreted.species_id == bindparam('species_id'))
+        params['species_id'] = species_id
     if inventory_id is not None:
-        objects = objects.filter_by(inventory_id=inventory_id)
+        bq += lambda q: q.filter(Interpreted.inventory_id == bindparam('inventory_id'))
+        params['inventory_id'] = inventory_id
     if spatial_filter is not None:
-        p = Point(spatial_filter['lon'], spatial_filter['lat'])
-        geog = cast(from_shape(p, srid=4326), Geography)
-        circle = geog.ST_Buffer(spatial_filter['radius'])
-        objects = objects.filter(Interpreted.geom.ST_Intersects(circle))
+        bq += lambda q: q.filter(_within_radius(Interpreted.geom))
+        params.update(lon=spatial_filter['lon'], lat=spatial_filter['lat'],
+                      radius=spatial_filter['radius'])
     # limit number of results
-    objects = objects.limit(n_samples).all()
+    if n_samples is not None:
+        bq += lambda q: q.limit(bindparam('n_samples'))
+        params['n_samples'] = n_samples
     return {'type': 'FeatureCollection',
-            'features': [x.geojson for x in objects]}
+            'features': _baked_features(session, bq, params, Interpreted,
+                                        precision=precision, tolerance=tolerance,
+                                        geom_format=geom_format)}
 
 
-def interpreted_by_id(session, id):
+def interpreted_by_id(session, id, precision=None, tolerance=None,
+                      geom_format='geojson'):
     """Get a single interpreted record by its id
+
+    See ``idb.interpreted`` for the geometry output arguments
     """
-    obj = session.query(Interpreted).get(id)
-    if obj is not None:
-        obj = obj.geojson
-    return obj
+    objects = session.query(Interpreted).filter(Interpreted.id == id)
+    features = _features(objects, Interpreted, precision=precision,
+                         tolerance=tolerance, geom_format=geom_format)
+    return features[0] if features else None
 
 
 def species(session):
@@ -265,30 +629,40 @@ def species(session):
     return [x.dict for x in objects]
 
 
-def studyareas(session):
+def studyareas(session, precision=None, tolerance=None, geom_format='geojson'):
     """Return a list of all study areas registered in the database
 
     Args:
         session: sqlalchemy database session
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
 
     Return:
         list: List of study areas (list of dict)
     """
     objects = session.query(Studyarea)
     return {'type': 'FeatureCollection',
-            'features': [x.geojson for x in objects]}
+            'features': _features(objects, Studyarea, precision=precision,
+                                  tolerance=tolerance, geom_format=geom_format)}
 
 
-def studyarea(session, id):
+def studyarea(session, id, precision=None, tolerance=None, geom_format='geojson'):
     """Query study area by id
+
+    See ``idb.studyareas`` for the geometry output arguments
     """
-    obj = session.query(Studyarea).get(id)
-    if obj is not None:
-        obj = obj.geojson
-    return obj
+    objects = session.query(Studyarea).filter(Studyarea.id == id)
+    features = _features(objects, Studyarea, precision=precision,
+                         tolerance=tolerance, geom_format=geom_format)
+    return features[0] if features else None
 
 
-def neighborhood(session, inventory_id=None, distance=None, species_id=None):
+def neighborhood(session, inventory_id=None, distance=None, species_id=None,
+                 precision=None, tolerance=None, geom_format='geojson'):
     """Performs a spatial search of inventory records in a given radius around a point
 
     Args:
@@ -297,30 +671,157 @@ def neighborhood(session, inventory_id=None, distance=None, species_id=None):
             performed around the geometry of that record
         distance (float): Search radius in meters
         species_id (list): A list of species_id to restrict the search to
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
 
     Return:
         dict: A feature collection of the inventory features intersecting with
             the search radius around the feature provided. The input feature is
             automatically excluded from the collection
     """
-    geog = cast(session.query(Inventory).get(inventory_id).geom, Geography)
-    buff = geog.ST_Buffer(distance)
+    def search(q):
+        # Geometry of the initial record, read by a subquery
+        center = aliased(Inventory)
+        origin = select([center.geom])\
+                .where(center.id == bindparam('inventory_id'))\
+                .as_scalar()
+        return q.filter(func.ST_DWithin(cast(Inventory.geom, GEOGRAPHY),
+                                        cast(origin, GEOGRAPHY),
+                                        bindparam('distance')))
     # Run the spatial search with no other restriction
-    objects = session.query(Inventory).filter(Inventory.geom.ST_Intersects(buff))
+    bq = bakery(lambda session: session.query(Inventory))
+    bq += search
     # Remove initial inventory record from the queryset
-    objects = objects.filter(Inventory.id != inventory_id)
+    bq += lambda q: q.filter(Inventory.id != bindparam('inventory_id'))
+    params = {'inventory_id': inventory_id, 'distance': distance}
     # Optionally restrict queryset to the species of interest
     if species_id is not None:
         if not isinstance(species_id, list):
             species_id = [species_id]
-        objects = objects.filter(Inventory.species_id.in_(species_id))
+        bq += lambda q: q.filter(Inventory.species_id.in_(bindparam('species_ids',
+                                                                     expanding=True)))
+        params['species_ids'] = species_id
     return {'type': 'FeatureCollection',
-            'features': [x.geojson for x in objects]}
+            'features': _baked_features(session, bq, params, Inventory,
+                                        precision=precision, tolerance=tolerance,
+                                        geom_format=geom_format)}
 
 neighbourhood = neighborhood
 
 
-def windows(session, experiment_id, union=True):
+def _match_query(session, interpreted_ids=None, species_id=None,
+                 unassigned_only=False, same_species=False):
+    """Build the query of match_interpreted, see that function for the arguments
+
+    Returns:
+        sqlalchemy.Query: Query of (interpreted id, current inventory id,
+            proposed inventory id, distance, contained) tuples
+    """
+    anchor = Interpreted.geom.ST_PointOnSurface()
+    candidates = session.query(Inventory.id.label('id'),
+                               Inventory.geom.label('geom'))
+    if same_species:
+        candidates = candidates.filter(Inventory.species_id == Interpreted.species_id)
+    if session.get_bind().dialect.name == 'postgresql':
+        nearest = candidates.order_by(Inventory.geom.distance_centroid(Interpreted.geom),
+                                      Inventory.geom.distance_centroid(anchor))\
+                .limit(1)\
+                .statement\
+                .correlate(Interpreted)\
+                .lateral('nearest')
+        objects = session.query(Interpreted.id, Interpreted.inventory_id,
+                                nearest.c.id,
+                                cast(nearest.c.geom, GEOGRAPHY)\
+                                        .ST_Distance(cast(Interpreted.geom, GEOGRAPHY)),
+                                nearest.c.geom.ST_Intersects(Interpreted.geom))\
+                .outerjoin(nearest, true())
+    else:
+        nearest_id = candidates.with_entities(Inventory.id)\
+                .order_by(func.ST_Distance(Inventory.geom, Interpreted.geom),
+                          func.ST_Distance(Inventory.geom, anchor))\
+                .limit(1)\
+                .correlate(Interpreted)\
+                .as_scalar()
+        objects = session.query(Interpreted.id, Interpreted.inventory_id,
+                                Inventory.id,
+                                func.ST_Distance(Inventory.geom, Interpreted.geom, 1),
+                                Inventory.geom.ST_Intersects(Interpreted.geom))\
+                .outerjoin(Inventory, Inventory.id == nearest_id)
+    if interpreted_ids is not None:
+        objects = objects.filter(Interpreted.id.in_(interpreted_ids))
+    if species_id is not None:
+        objects = objects.filter(Interpreted.species_id == species_id)
+    if unassigned_only:
+        objects = objects.filter(Interpreted.inventory_id.is_(None))
+    return objects
+
+
+def match_interpreted(session, interpreted_ids=None, species_id=None,
+                      unassigned_only=False, same_species=False, apply=False):
+    """Match interpreted polygons with their nearest inventory record
+
+    Inventory records are ranked by their distance to the polygon (0 when the
+    polygon contains them), ties (e.g. several records inside the crown) being
+    broken by the distance to a point guaranteed to lie on the polygon surface
+    (ST_PointOnSurface). On postgis, all polygons are matched in a single query
+    with a lateral join ordered by the KNN distance operator (``<->``, exact
+    point to polygon distance, index assisted); on sqlite a correlated subquery
+    is used instead
+
+    Args:
+        session: sqlalchemy database session
+        interpreted_ids (list): Optional list of interpreted ids to match
+        species_id (int): Optionally only match polygons of that species
+        unassigned_only (bool): Only match polygons without inventory_id
+        same_species (bool): Only consider inventory records of the same species
+            as the polygon
+        apply (bool): Update ``inventory_id`` of the mismatched polygons with the
+            proposed inventory record
+
+    Return:
+        dict: With keys ``assignments`` (one dict per polygon with keys
+            ``interpreted_id``, ``inventory_id`` (current), ``proposed_inventory_id``,
+            ``distance`` (between the inventory point and the polygon, in meters)
+            and ``contained`` (whether the polygon contains the inventory point))
+            and ``mismatches`` (the assignments where proposed and current
+            inventory ids differ)
+    """
+    objects = _match_query(session, interpreted_ids=interpreted_ids,
+                           species_id=species_id, unassigned_only=unassigned_only,
+                           same_species=same_species)
+    assignments = [{'interpreted_id': id,
+                    'inventory_id': inventory_id,
+                    'proposed_inventory_id': proposed,
+                    'distance': distance,
+                    'contained': bool(contained) if contained is not None else None}
+                   for id, inventory_id, proposed, distance, contained in objects]
+    mismatches = [x for x in assignments
+                  if x['proposed_inventory_id'] != x['inventory_id']]
+    if apply:
+        to_apply = [x for x in mismatches if x['proposed_inventory_id'] is not None]
+        affected = [x['inventory_id'] for x in to_apply]\
+                + [x['proposed_inventory_id'] for x in to_apply]
+        proposed = {x['interpreted_id']: x['proposed_inventory_id'] for x in to_apply}
+        ids = list(proposed)
+        with stats.tracking(session, affected):
+            # One update per chunk of polygons (sqlite limits the number of
+            # parameters of a statement)
+            for i in range(0, len(ids), 300):
+                chunk = {k: proposed[k] for k in ids[i:i + 300]}
+                session.query(Interpreted)\
+                        .filter(Interpreted.id.in_(list(chunk)))\
+                        .update({'inventory_id': case(chunk, value=Interpreted.id)},
+                                synchronize_session=False)
+    return {'assignments': assignments,
+            'mismatches': mismatches}
+
+
+def windows(session, experiment_id, union=True, precision=None, tolerance=None,
+            geom_format='geojson'):
     """Retrieve all windows of an experiment
 
     Overlapping windows are optionally unioned and the properties of the
@@ -331,6 +832,12 @@ def windows(session, experiment_id, union=True):
         experiment_id (int): Database id of an experiment record
         union (bool): Whether to union (see postgis' ST_Union) the overlapping
             windows
+        precision (int): Optional number of decimal digits of the output
+            coordinates (rounding is done by the database)
+        tolerance (float): Optional simplification tolerance, in degrees
+            (topology preserving simplification done by the database)
+        geom_format (str): Output geometry encoding, either ``'geojson'`` (dict,
+            default) or ``'wkb'`` (bytes, well known binary)
 
     Return:
         dict: A feature collection of the windows belonging to that experiment
@@ -338,18 +845,29 @@ def windows(session, experiment_id, union=True):
     if union:
         sq = session.query(Trainwindow.geom.ST_Union().ST_Dump().geom.label('geom'))\
                 .filter(Trainwindow.experiment_id==experiment_id).subquery()
-        q = session.query(sq.c.geom.label('geom'),
+        geom = _geom_expression(sq.c.geom, precision=precision,
+                                tolerance=tolerance, geom_format=geom_format,
+                                dialect=session.get_bind().dialect.name)
+        if geom is None:
+            geom = sq.c.geom
+        q = session.query(geom.label('geom'),
                           func.array_agg(Trainwindow.id).label('ids'),
                           func.bool_and(Trainwindow.complete).label('all_complete'))\
                 .filter(Trainwindow.experiment_id==experiment_id)\
                 .join(sq, sq.c.geom.ST_Intersects(Trainwindow.geom.ST_Centroid()))\
                 .group_by(sq.c.geom).all()
-        fc = [{'geometry': mapping(to_shape(item.geom)),
+        fc = [{'geometry': _geometry(item.geom, geom_format),
                'properties': {'ids': item.ids,
                               'all_complete': item.all_complete}} for item in q]
     else:
-        q = session.query(Trainwindow).filter_by(experiment_id=experiment_id)
-        fc = [{'geometry': mapping(to_shape(item.geom)),
+        geom = _geom_expression(Trainwindow.geom, precision=precision,
+                                tolerance=tolerance, geom_format=geom_format,
+                                dialect=session.get_bind().dialect.name)
+        if geom is None:
+            geom = Trainwindow.geom
+        q = session.query(Trainwindow.id, Trainwindow.complete, geom.label('geom'))\
+                .filter_by(experiment_id=experiment_id)
+        fc = [{'geometry': _geometry(item.geom, geom_format),
                'properties': {'ids': [item.id],
                               'all_complete': item.complete}} for item in q]
     return {'type': 'FeatureCollection',
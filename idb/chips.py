@@ -0,0 +1,177 @@
+"""Training chips extraction
+
+Builds, for every training window of an experiment, a label array with the
+species id of the interpreted crown covering each pixel (0 for background).
+Interpreted polygons of all windows are fetched with a single spatial join,
+rasterized with vectorized numpy operations (scanline even-odd filling of each
+polygon within its bounding box) by a pool of worker processes, and written as
+compressed ``.npz`` files along with a json index.
+"""
+from itertools import groupby
+from multiprocessing import Pool
+import json
+import os
+
+import numpy as np
+from shapely import wkb
+from geoalchemy2.shape import to_shape
+from sqlalchemy.sql import func
+
+from idb.models import Trainwindow, Interpreted
+
+
+def _edges(polygon):
+    """All edges of the rings of a polygon, as a (n, 4) array of x1, y1, x2, y2"""
+    rings = [polygon.exterior] + list(polygon.interiors)
+    out = []
+    for ring in rings:
+        coords = np.asarray(ring.coords)[:, :2]
+        out.append(np.hstack([coords[:-1], coords[1:]]))
+    return np.vstack(out)
+
+
+def _window(polygon, bounds, resolution, shape):
+    """Rows and columns (first, last) of the pixels whose center falls in the
+    bounding box of a polygon, None when outside the array"""
+    minx, miny, maxx, maxy = bounds
+    pminx, pminy, pmaxx, pmaxy = polygon.bounds
+    r0 = max(int(np.ceil((maxy - pmaxy) / resolution - 0.5)), 0)
+    r1 = min(int(np.floor((maxy - pminy) / resolution - 0.5)), shape[0] - 1)
+    c0 = max(int(np.ceil((pminx - minx) / resolution - 0.5)), 0)
+    c1 = min(int(np.floor((pmaxx - minx) / resolution - 0.5)), shape[1] - 1)
+    if r0 > r1 or c0 > c1:
+        return None
+    return r0, r1, c0, c1
+
+
+def _mask(polygon, bounds, resolution, window):
+    """Scanline even-odd fill of a polygon within a window of pixels
+
+    Returns:
+        numpy.ndarray: Boolean array of the window shape, True for pixels whose
+            center is inside the polygon
+    """
+    minx, miny, maxx, maxy = bounds
+    r0, r1, c0, c1 = window
+    width = c1 - c0 + 1
+    x1, y1, x2, y2 = _edges(polygon).T
+    # Rows whose center y is in [min(y1, y2), max(y1, y2)), horizontal edges
+    # have no such row
+    ylo = np.minimum(y1, y2)
+    yhi = np.maximum(y1, y2)
+    row_start = np.floor((maxy - yhi) / resolution - 0.5).astype(int) + 1
+    row_stop = np.floor((maxy - ylo) / resolution - 0.5).astype(int)
+    row_start = np.clip(row_start, r0, r1 + 1)
+    row_stop = np.clip(row_stop, r0 - 1, r1)
+    counts = np.maximum(row_stop - row_start + 1, 0)
+    # One item per (edge, row) crossing
+    edge = np.repeat(np.arange(len(x1)), counts)
+    offsets = np.cumsum(counts) - counts
+    rows = row_start[edge] + np.arange(counts.sum()) - offsets[edge]
+    yc = maxy - (rows + 0.5) * resolution
+    xc = x1[edge] + (yc - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+    # First pixel whose center is right of the crossing, crossings left of the
+    # window count for its first column
+    cols = np.floor((xc - minx) / resolution - 0.5).astype(int) + 1
+    cols = np.clip(cols, c0, c1 + 1) - c0
+    # Pixels right of an odd number of crossings are inside (even-odd rule);
+    # uint8 overflow preserves parity
+    crossings = np.zeros((r1 - r0 + 1, width + 1), dtype=np.uint8)
+    np.add.at(crossings, (rows - r0, cols), 1)
+    return (np.cumsum(crossings, axis=1, dtype=np.uint8) & 1)[:, :width].astype(bool)
+
+
+def rasterize(polygons, values, bounds, resolution, dtype=np.uint16):
+    """Rasterize polygons into a label array
+
+    A pixel takes the value of the polygon containing its center; when several
+    polygons overlap, the last one in the list wins. Each polygon is filled
+    within its own bounding box, memory use is therefore driven by the size of
+    the largest polygon rather than by the number of polygons
+
+    Args:
+        polygons (list): List of shapely polygons
+        values (list): Value to burn for each polygon (e.g. species id)
+        bounds (tuple): (minx, miny, maxx, maxy) extent of the output array
+        resolution (float): Pixel size, in coordinates units (degrees)
+        dtype: numpy data type of the output array
+
+    Returns:
+        numpy.ndarray: 2D array of shape (rows, cols), with the first row at maxy
+    """
+    minx, miny, maxx, maxy = bounds
+    width = int(np.ceil((maxx - minx) / resolution))
+    height = int(np.ceil((maxy - miny) / resolution))
+    labels = np.zeros((height, width), dtype=dtype)
+    for polygon, value in zip(polygons, values):
+        window = _window(polygon, bounds, resolution, labels.shape)
+        if window is None:
+            continue
+        r0, r1, c0, c1 = window
+        mask = _mask(polygon, bounds, resolution, window)
+        labels[r0:r1 + 1, c0:c1 + 1][mask] = value
+    return labels
+
+
+def _write_chip(task):
+    """Rasterize and write the chip of a window (worker function)"""
+    window_id, bounds, resolution, items, out_dir = task
+    polygons = [wkb.loads(bytes(geom)) for _, geom in items]
+    labels = rasterize(polygons, [species_id for species_id, _ in items],
+                       bounds=bounds, resolution=resolution)
+    filename = '%d.npz' % window_id
+    transform = np.array([bounds[0], resolution, bounds[3], -resolution])
+    np.savez_compressed(os.path.join(out_dir, filename), labels=labels,
+                        transform=transform)
+    return {'id': window_id, 'file': filename, 'shape': list(labels.shape),
+            'bounds': list(bounds), 'n_polygons': len(polygons)}
+
+
+def extract_chips(session, experiment_id, resolution, out_dir, processes=None):
+    """Extract label chips for all training windows of an experiment
+
+    Each window is written to ``<out_dir>/<window id>.npz`` with arrays
+    ``labels`` (species id per pixel, 0 for background) and ``transform``
+    (x origin, pixel width, y origin, pixel height); ``<out_dir>/index.json``
+    lists the chips
+
+    Args:
+        session: sqlalchemy database session
+        experiment_id (int): Database id of an experiment record
+        resolution (float): Pixel size, in degrees
+        out_dir (str): Output directory, created if it does not exist
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs
+
+    Return:
+        list: The chips index (list of dict)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    bounds = {x.id: to_shape(x.geom).bounds for x in
+              session.query(Trainwindow.id, Trainwindow.geom)\
+                      .filter(Trainwindow.experiment_id == experiment_id)}
+    # Interpreted polygons of all windows, in a single spatial join
+    q = session.query(Trainwindow.id, Interpreted.species_id,
+                      func.ST_AsBinary(Interpreted.geom))\
+            .join(Interpreted, Interpreted.geom.ST_Intersects(Trainwindow.geom))\
+            .filter(Trainwindow.experiment_id == experiment_id)\
+            .order_by(Trainwindow.id, Interpreted.id)\
+            .yield_per(1000)
+
+    def tasks():
+        # Windows are streamed to the workers as the join results are read
+        for window_id, rows in groupby(q, key=lambda x: x[0]):
+            yield (window_id, bounds.pop(window_id), resolution,
+                   [(species_id, bytes(geom)) for _, species_id, geom in rows],
+                   out_dir)
+        # Windows without interpreted polygons
+        for window_id, window_bounds in list(bounds.items()):
+            yield (window_id, window_bounds, resolution, [], out_dir)
+
+    with Pool(processes) as pool:
+        index = list(pool.imap_unordered(_write_chip, tasks(), chunksize=4))
+    index.sort(key=lambda x: x['id'])
+    with open(os.path.join(out_dir, 'index.json'), 'w') as dst:
+        json.dump({'experiment_id': experiment_id, 'resolution': resolution,
+                   'chips': index}, dst)
+    return index
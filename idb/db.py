@@ -1,17 +1,120 @@
 from contextlib import contextmanager
+from itertools import cycle
+import threading
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import URL
 from sqlalchemy.event import listen
 from sqlalchemy.sql import select, func
+from sqlalchemy.sql.selectable import Select, CompoundSelect
 
 from idb.globals import DB_CONFIG
 
+
+class ReplicaSet(object):
+    """Round robin over the read replicas of an env, skipping unhealthy ones
+
+    The health of a replica (successful ``SELECT 1``) is checked at most every
+    ``check_interval`` seconds, the result being cached in between. Checks run
+    outside of the lock, an unreachable replica only delays the sessions that
+    check it (see ``REPLICA_CONNECT_TIMEOUT``)
+
+    Args:
+        engines (list): Engines of the replicas
+        check_interval (float): Seconds between two health checks of a replica
+    """
+    def __init__(self, engines, check_interval=30):
+        self.engines = engines
+        self.check_interval = check_interval
+        self._cycle = cycle(engines)
+        self._status = {}
+        self._lock = threading.Lock()
+
+    def _healthy(self, engine):
+        healthy, checked = self._status.get(engine, (True, None))
+        if checked is not None and time.time() - checked < self.check_interval:
+            return healthy
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            healthy = True
+        except Exception:
+            healthy = False
+        self._status[engine] = (healthy, time.time())
+        return healthy
+
+    def get(self):
+        """Next healthy replica engine, None if all replicas are down"""
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = next(self._cycle)
+            if self._healthy(engine):
+                return engine
+        return None
+
+
+class RoutingSession(Session):
+    """Session sending reads to a replica and writes to the primary
+
+    SELECT statements go to a replica (picked once per session) until the
+    session writes; flushes, other statements (insert, update, delete, text) and
+    SELECT ... FOR UPDATE go to the primary, as does everything that follows them
+    in the same session so that reads see the session's own writes
+    """
+    def __init__(self, replica_set=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replica_set = replica_set
+        self._replica = None
+        self._use_primary = False
+
+    def use_primary(self):
+        """Send all subsequent statements of the session to the primary"""
+        self._use_primary = True
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super(RoutingSession, self).get_bind(mapper=mapper, clause=clause,
+                                                       **kwargs)
+        if self.replica_set is None or (mapper is None and clause is None):
+            return primary
+        is_read = isinstance(clause, (Select, CompoundSelect))\
+                and getattr(clause, '_for_update_arg', None) is None
+        if self._flushing or not is_read:
+            self._use_primary = True
+        if self._use_primary:
+            return primary
+        if self._replica is None:
+            self._replica = self.replica_set.get() or primary
+        return self._replica
+
+
+# Seconds after which a connection attempt to a replica is abandoned
+REPLICA_CONNECT_TIMEOUT = 5
+
+
+def _url_kwargs(section):
+    return {k:v for k,v in section.items() if k != 'replicas'}
+
+
+def _engine_kwargs(url, is_replica):
+    if is_replica and not url.drivername.startswith('sqlite'):
+        return {'connect_args': {'connect_timeout': REPLICA_CONNECT_TIMEOUT}}
+    return {}
+
+# Envs used as read replicas of another env
+replica_envs = {x.strip() for v in DB_CONFIG.values() if v.get('replicas')
+                for x in v['replicas'].split(',') if x.strip()}
 # Make a dict of URLs and dict of engines
-urls = {k:URL(**v) for k,v in DB_CONFIG.items()}
-engines = {k:create_engine(v) for k,v in urls.items()}
+urls = {k:URL(**_url_kwargs(v)) for k,v in DB_CONFIG.items()}
+engines = {k:create_engine(v, **_engine_kwargs(v, k in replica_envs))
+           for k,v in urls.items()}
+# Read replicas, declared as a comma separated list of env names
+# (e.g. replicas=main_ro1,main_ro2 in the [main] section)
+replicas = {k:ReplicaSet([engines[x.strip()] for x in v['replicas'].split(',')
+                          if x.strip()])
+            for k,v in DB_CONFIG.items() if v.get('replicas')}
 
 Base = declarative_base()
 
@@ -21,8 +124,35 @@ def load_spatialite(dbapi_conn, connection_record):
     dbapi_conn.load_extension('/usr/lib/x86_64-linux-gnu/mod_spatialite.so')
 
 
+def add_missing_columns(engine):
+    """Add columns declared in the models but absent from existing tables
+
+    Allows databases created by older versions of idb to be upgraded by
+    re-running init_db. Geometry columns, server defaults and constraints are not
+    handled; rows existing before the upgrade get null values
+
+    Returns:
+        list: Added columns as table.column strings
+    """
+    from geoalchemy2 import Geometry
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or isinstance(column.type, Geometry):
+                    continue
+                conn.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                             % (table.name, column.name,
+                                column.type.compile(dialect=engine.dialect)))
+                added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
 def init_db(env='main', engines=engines):
     import idb.models
+    from idb.indexes import create_indexes
     engine = engines[env]
     if engine.url.drivername.startswith('sqlite'):
         listen(engine, 'connect', load_spatialite)
@@ -30,16 +160,22 @@ def init_db(env='main', engines=engines):
         conn.execute(select([func.InitSpatialMetaData()]))
         conn.close()
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    create_indexes(env=env, engines=engines)
 
 
 @contextmanager
-def session_scope(env='main', engines=engines):
+def session_scope(env='main', engines=engines, replicas=replicas):
     """Provide a transactional scope around a series of operations.
+
+    When read replicas are declared for the env, reads are sent to one of them
+    until the first write of the scope (see RoutingSession)
     """
     engine = engines[env]
     if engine.url.drivername.startswith('sqlite'):
         listen(engine, 'connect', load_spatialite)
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=engine, class_=RoutingSession,
+                           replica_set=replicas.get(env))
     session = Session()
     try:
         yield session
@@ -0,0 +1,270 @@
+"""Index provisioning and maintenance
+
+Indexes that cannot be fully expressed through the declarative models (partial,
+expression and spatial indexes) or that must be guaranteed on databases created
+by older versions of idb are defined here, for each supported backend.
+"""
+from collections import namedtuple
+import warnings
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.event import listen, contains
+
+from idb.db import engines, load_spatialite, add_missing_columns
+from idb.utils import hilbert_key
+
+
+IndexSpec = namedtuple('IndexSpec', ['name', 'table', 'postgresql', 'sqlite'])
+
+# Geometry columns, (table, column)
+GEOMETRY_COLUMNS = [('inventory', 'geom'),
+                    ('interpreted', 'geom'),
+                    ('tile', 'geom'),
+                    ('studyarea', 'geom'),
+                    ('trainwindow', 'geom')]
+
+INDEXES = [
+    # Default sampling query of the labelling tool: not yet interpreted records,
+    # optionally of a given species and tile
+    IndexSpec('ix_inventory_uninterpreted_species_tile', 'inventory',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_uninterpreted_species_tile '
+              'ON inventory (species_id, tile_id) WHERE is_interpreted IS FALSE',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_uninterpreted_species_tile '
+              'ON inventory (species_id, tile_id) WHERE is_interpreted IS 0'),
+    IndexSpec('ix_inventory_interpreted_species_tile', 'inventory',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_interpreted_species_tile '
+              'ON inventory (is_interpreted, species_id, tile_id)',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_interpreted_species_tile '
+              'ON inventory (is_interpreted, species_id, tile_id)'),
+    # Natural key of the inventory (also declared in the model), required for
+    # upserts. Fails if the table already contains duplicated keys
+    IndexSpec('uq_inventory_tile_id_exp_num', 'inventory',
+              'CREATE UNIQUE INDEX IF NOT EXISTS uq_inventory_tile_id_exp_num '
+              'ON inventory (tile_id, exp_num)',
+              'CREATE UNIQUE INDEX IF NOT EXISTS uq_inventory_tile_id_exp_num '
+              'ON inventory (tile_id, exp_num)'),
+    # One progress row per key (also declared in the model), required by the
+    # increments of idb.stats. Fails if the table already contains duplicated
+    # keys, rebuild_progress.py removes them and creates the index
+    IndexSpec('uq_progress_key', 'progress',
+              'CREATE UNIQUE INDEX IF NOT EXISTS uq_progress_key ON progress '
+              '(coalesce(species_id, -1), coalesce(tile_id, -1), coalesce(studyarea_id, -1))',
+              'CREATE UNIQUE INDEX IF NOT EXISTS uq_progress_key ON progress '
+              '(coalesce(species_id, -1), coalesce(tile_id, -1), coalesce(studyarea_id, -1))'),
+    # Foreign keys not indexed by the models
+    IndexSpec('ix_interpreted_inventory_id', 'interpreted',
+              'CREATE INDEX IF NOT EXISTS ix_interpreted_inventory_id '
+              'ON interpreted (inventory_id)',
+              'CREATE INDEX IF NOT EXISTS ix_interpreted_inventory_id '
+              'ON interpreted (inventory_id)'),
+    IndexSpec('ix_trainwindow_experiment_id', 'trainwindow',
+              'CREATE INDEX IF NOT EXISTS ix_trainwindow_experiment_id '
+              'ON trainwindow (experiment_id)',
+              'CREATE INDEX IF NOT EXISTS ix_trainwindow_experiment_id '
+              'ON trainwindow (experiment_id)'),
+    # Change tracking columns (see idb.sync), declared in the models but
+    # absent from databases upgraded with db.add_missing_columns
+    IndexSpec('ix_inventory_time_updated', 'inventory',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_time_updated '
+              'ON inventory (time_updated)',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_time_updated '
+              'ON inventory (time_updated)'),
+    IndexSpec('ix_interpreted_time_updated', 'interpreted',
+              'CREATE INDEX IF NOT EXISTS ix_interpreted_time_updated '
+              'ON interpreted (time_updated)',
+              'CREATE INDEX IF NOT EXISTS ix_interpreted_time_updated '
+              'ON interpreted (time_updated)'),
+    IndexSpec('ix_trainwindow_time_updated', 'trainwindow',
+              'CREATE INDEX IF NOT EXISTS ix_trainwindow_time_updated '
+              'ON trainwindow (time_updated)',
+              'CREATE INDEX IF NOT EXISTS ix_trainwindow_time_updated '
+              'ON trainwindow (time_updated)'),
+    # Hilbert key of the inventory records, used to cluster the table (see
+    # cluster)
+    IndexSpec('ix_inventory_hilbert', 'inventory',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_hilbert '
+              'ON inventory (hilbert)',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_hilbert '
+              'ON inventory (hilbert)'),
+    # Sync keys (see idb.sync), declared in the models but absent from
+    # databases upgraded with db.add_missing_columns
+    IndexSpec('ix_inventory_uid', 'inventory',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_inventory_uid ON inventory (uid)',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_inventory_uid ON inventory (uid)'),
+    IndexSpec('ix_interpreted_uid', 'interpreted',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_interpreted_uid ON interpreted (uid)',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_interpreted_uid ON interpreted (uid)'),
+    IndexSpec('ix_trainwindow_uid', 'trainwindow',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_trainwindow_uid ON trainwindow (uid)',
+              'CREATE UNIQUE INDEX IF NOT EXISTS ix_trainwindow_uid ON trainwindow (uid)'),
+    # Radius searches cast geometries to geography
+    IndexSpec('ix_inventory_geog', 'inventory',
+              'CREATE INDEX IF NOT EXISTS ix_inventory_geog '
+              'ON inventory USING GIST ((geom::geography))',
+              None),
+    IndexSpec('ix_interpreted_geog', 'interpreted',
+              'CREATE INDEX IF NOT EXISTS ix_interpreted_geog '
+              'ON interpreted USING GIST ((geom::geography))',
+              None),
+]
+
+# GiST (postgis) or R*Tree (spatialite) index on every geometry column. Names
+# follow those used by geoalchemy2 so that existing indexes are recognized
+INDEXES += [IndexSpec('idx_%s_%s' % (table, column), table,
+                      'CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s USING GIST (%s)'\
+                              % (table, column, table, column),
+                      "SELECT CreateSpatialIndex('%s', '%s')" % (table, column))
+            for table, column in GEOMETRY_COLUMNS]
+
+
+def _get_engine(env, engines):
+    engine = engines[env]
+    if engine.url.drivername.startswith('sqlite')\
+            and not contains(engine, 'connect', load_spatialite):
+        listen(engine, 'connect', load_spatialite)
+    return engine
+
+
+def _dialect(engine):
+    return 'sqlite' if engine.url.drivername.startswith('sqlite') else 'postgresql'
+
+
+def _existing_indexes(conn, dialect):
+    if dialect == 'sqlite':
+        q = "SELECT name FROM sqlite_master WHERE type IN ('index', 'table')"
+    else:
+        q = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+    return {row[0] for row in conn.execute(text(q))}
+
+
+def create_indexes(env='main', engines=engines):
+    """Create the indexes defined in ``INDEXES`` that do not exist yet
+
+    Each index is created in its own transaction. Unique indexes that cannot be
+    created because of duplicated rows are skipped with a warning
+
+    Returns:
+        list: Names of the indexes created
+    """
+    engine = _get_engine(env, engines)
+    dialect = _dialect(engine)
+    created = []
+    with engine.connect() as conn:
+        existing = _existing_indexes(conn, dialect)
+    for spec in INDEXES:
+        ddl = getattr(spec, dialect)
+        if ddl is None or spec.name in existing:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+        except IntegrityError as e:
+            warnings.warn('Could not create unique index %s, the table contains '
+                          'duplicates: %s' % (spec.name, e.orig))
+            continue
+        created.append(spec.name)
+    return created
+
+
+def missing_indexes(env='main', engines=engines):
+    """List the indexes defined in ``INDEXES`` that are absent from the database
+    """
+    engine = _get_engine(env, engines)
+    dialect = _dialect(engine)
+    with engine.connect() as conn:
+        existing = _existing_indexes(conn, dialect)
+    return [spec.name for spec in INDEXES
+            if getattr(spec, dialect) is not None and spec.name not in existing]
+
+
+def unused_indexes(env='main', engines=engines):
+    """List indexes that have never been scanned since statistics were last reset
+
+    Primary keys and unique indexes are excluded. Only available for postgres;
+    sqlite does not collect index usage statistics and an empty list is returned
+    """
+    engine = _get_engine(env, engines)
+    if _dialect(engine) == 'sqlite':
+        return []
+    q = text("""SELECT s.indexrelname FROM pg_stat_user_indexes s
+                JOIN pg_index i ON i.indexrelid = s.indexrelid
+                WHERE s.idx_scan = 0 AND NOT i.indisunique
+                AND s.schemaname = current_schema()
+                ORDER BY s.relname, s.indexrelname""")
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(q)]
+
+
+def maintain(env='main', engines=engines, vacuum=False):
+    """Refresh planner statistics and report on the indexes
+
+    Runs ANALYZE (VACUUM ANALYZE when vacuum is True) on the whole database.
+    VACUUM cannot run inside a transaction, the statements are therefore issued in
+    autocommit mode
+
+    Returns:
+        dict: With keys ``missing`` and ``unused``, see ``missing_indexes`` and
+            ``unused_indexes``
+    """
+    engine = _get_engine(env, engines)
+    dialect = _dialect(engine)
+    if dialect == 'sqlite':
+        statements = ['VACUUM', 'ANALYZE'] if vacuum else ['ANALYZE']
+    else:
+        statements = ['VACUUM ANALYZE'] if vacuum else ['ANALYZE']
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            conn.execute(text(statement))
+    return {'missing': missing_indexes(env=env, engines=engines),
+            'unused': unused_indexes(env=env, engines=engines)}
+
+
+def cluster(env='main', engines=engines, chunk_size=10000):
+    """Store the inventory records in the order of their Hilbert key
+
+    Keys missing from records ingested by older versions of idb are computed
+    first. On postgres the table is then rewritten in key order (CLUSTER, which
+    locks the table for the duration of the rewrite) and analyzed; the order is
+    not maintained by later writes, but ingested batches are sorted by key. On
+    sqlite rows are stored in primary key order and cannot be reordered without
+    changing their ids; clustering there only results from the ingest order and
+    the database is vacuumed and analyzed
+
+    Args:
+        env (str): env to use (database), as defined in the .idb file
+        engines (dict): Engines of the envs, see ``idb.db.engines``
+        chunk_size (int): Number of keys computed and written per transaction
+
+    Returns:
+        int: Number of keys computed
+    """
+    engine = _get_engine(env, engines)
+    dialect = _dialect(engine)
+    # Databases created by older versions lack the column and its index
+    add_missing_columns(engine)
+    create_indexes(env=env, engines=engines)
+    pending = text('SELECT id, ST_X(geom), ST_Y(geom) FROM inventory '
+                  'WHERE hilbert IS NULL AND geom IS NOT NULL ORDER BY id LIMIT :n')
+    update = text('UPDATE inventory SET hilbert = :hilbert WHERE id = :id')
+    n_keys = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(pending, n=chunk_size).fetchall()
+            if rows:
+                conn.execute(update, [{'id': id, 'hilbert': hilbert_key(lon, lat)}
+                                      for id, lon, lat in rows])
+        n_keys += len(rows)
+        if len(rows) < chunk_size:
+            break
+    if dialect == 'sqlite':
+        statements = ['VACUUM', 'ANALYZE']
+    else:
+        statements = ['CLUSTER inventory USING ix_inventory_hilbert',
+                      'ANALYZE inventory']
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            conn.execute(text(statement))
+    return n_keys
@@ -0,0 +1,154 @@
+"""Parallel ingestion of inventory files
+
+Inventory files are multilayer vector files (e.g. geopackages) with inventory
+tiles in layer 'tiles', inventory samples in layer 'inventory' and study areas in
+layer 'studyarea' (see ingest_inventory.py). Tiles, study areas, and the species
+and tile lookups are handled once in the main process; the inventory layers are
+split in chunks of features that are converted and inserted by a pool of
+worker processes, each with its own database engine.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fiona
+from sqlalchemy import create_engine
+from sqlalchemy.event import listen
+
+from idb.db import urls, engines, session_scope, load_spatialite
+from idb.models import Species, Tile, Studyarea
+from idb import add_inventories, upsert_inventories, stats
+
+
+def lookups(session, tile_names=()):
+    """Build the species and tile lookup dictionaries used for ingestion
+
+    Tiles that do not exist yet in the database are created (without geometry)
+
+    Args:
+        session: sqlalchemy database session
+        tile_names (iterable): Names of the tiles referenced by the features to
+            ingest (``PLACETTE`` attribute)
+
+    Returns:
+        tuple: Two dictionaries, species codes to species ids and tile names to
+            tile ids
+    """
+    # Missing tiles are inserted, existing ones must not be read from a
+    # lagging read replica
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    species_ids = dict(session.query(Species.code, Species.id))
+    tile_ids = dict(session.query(Tile.name, Tile.id))
+    missing = [Tile(name=name) for name in set(tile_names) - set(tile_ids)]
+    session.add_all(missing)
+    session.flush()
+    tile_ids.update({tile.name: tile.id for tile in missing})
+    return species_ids, tile_ids
+
+
+def _prepare(path, session):
+    """Ingest tiles and study areas of a file and collect its tile names
+
+    Returns:
+        tuple: Number of features in the inventory layer and set of tile names
+    """
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    existing = {x[0] for x in session.query(Tile.name)}
+    with fiona.open(path, layer='tiles') as src:
+        session.add_all([Tile.from_geojson(feature) for feature in src
+                         if feature['properties']['name'] not in existing])
+    existing = {x[0] for x in session.query(Studyarea.name)}
+    with fiona.open(path, layer='studyarea') as src:
+        studyareas = [Studyarea.from_geojson(feature) for feature in src
+                      if feature['properties']['name'] not in existing]
+    session.add_all(studyareas)
+    with fiona.open(path, layer='inventory') as src:
+        n_features = len(src)
+        tile_names = {feature['properties']['PLACETTE'] for feature in src}
+    session.flush()
+    # Records ingested previously that fall in the new study areas
+    stats.add_studyareas(session, [x.id for x in studyareas])
+    return n_features, tile_names
+
+
+# Per worker process state, set by _init_worker
+_worker = {}
+
+
+def _init_worker(env, species_ids, tile_ids, upsert):
+    engine = create_engine(urls[env])
+    if engine.url.drivername.startswith('sqlite'):
+        listen(engine, 'connect', load_spatialite)
+    _worker.update(env=env, engines={env: engine}, species_ids=species_ids,
+                   tile_ids=tile_ids, upsert=upsert)
+
+
+def _ingest_chunk(path, start, stop):
+    with fiona.open(path, layer='inventory') as src:
+        features = [feature for _, feature in src.items(start, stop)]
+    with session_scope(env=_worker['env'], engines=_worker['engines'],
+                       replicas={}) as session:
+        if _worker['upsert']:
+            upsert_inventories(session, features,
+                               species_ids=_worker['species_ids'],
+                               tile_ids=_worker['tile_ids'])
+        else:
+            add_inventories(session, features,
+                            species_ids=_worker['species_ids'],
+                            tile_ids=_worker['tile_ids'])
+    return len(features)
+
+
+def ingest_files(paths, env='main', processes=None, chunk_size=5000,
+                 upsert=False, callback=None):
+    """Ingest several inventory files using a pool of worker processes
+
+    Each chunk is inserted in its own transaction; a failing chunk does not
+    prevent the others from being ingested and is reported in the output
+
+    Args:
+        paths (list): Paths of the multilayer vector files to ingest
+        env (str): env to use (database), as defined in the .idb file
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs
+        chunk_size (int): Maximum number of inventory features per task
+        upsert (bool): Insert or update records on their (tile, exploitation
+            number) key instead of always inserting (see
+            ``idb.upsert_inventories``)
+        callback (callable): Optional function called in the main process after
+            each chunk, with a dict with keys ``path``, ``start``, ``stop``,
+            ``n`` (records processed) and ``error`` (None or error message)
+
+    Returns:
+        dict: Report with keys ``processed`` (total number of records processed),
+            ``chunks`` (number of chunks) and ``errors`` (list of failed chunks,
+            same dicts as passed to callback)
+    """
+    tasks = []
+    tile_names = set()
+    with session_scope(env=env) as session:
+        for path in paths:
+            n_features, names = _prepare(path, session)
+            tile_names.update(names)
+            tasks += [(path, start, min(start + chunk_size, n_features))
+                      for start in range(0, n_features, chunk_size)]
+        species_ids, tile_ids = lookups(session, tile_names)
+    # Connections of the main process must not be shared with the workers
+    engines[env].dispose()
+    report = {'processed': 0, 'chunks': len(tasks), 'errors': []}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(env, species_ids, tile_ids, upsert)) as executor:
+        futures = {executor.submit(_ingest_chunk, *task): task for task in tasks}
+        for future in as_completed(futures):
+            path, start, stop = futures[future]
+            result = {'path': path, 'start': start, 'stop': stop, 'n': 0,
+                      'error': None}
+            try:
+                result['n'] = future.result()
+            except Exception as e:
+                result['error'] = '%s: %s' % (type(e).__name__, e)
+                report['errors'].append(result)
+            report['processed'] += result['n']
+            if callback is not None:
+                callback(result)
+    return report
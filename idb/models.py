@@ -1,16 +1,22 @@
 import datetime as dt
+import uuid
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text
-from sqlalchemy import DateTime, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Boolean, Text
+from sqlalchemy import DateTime, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, literal_column
+from sqlalchemy.event import listen
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import from_shape, to_shape
 
 from shapely.geometry import shape, mapping
 
 from idb.db import Base
-from idb.utils import get_or_create
+from idb.utils import get_or_create, hilbert_key
+
+
+def _uid():
+    return str(uuid.uuid4())
 
 
 class Species(Base):
@@ -42,7 +48,21 @@ class Inventory(Base):
     dbh = Column(Integer)
     is_interpreted = Column(Boolean) # Whether this sample has already been interpreted or not
     comment = Column(Text, nullable=True)
-    # UniqueConstraint(tile_id, exp_num)
+    # Position along a Hilbert curve (see idb.utils.hilbert_key), records are
+    # inserted and clustered in that order
+    hilbert = Column(BigInteger, index=True)
+    # Globally unique id, rows are matched on it by idb.sync
+    uid = Column(String(36), default=_uid, index=True,
+                 unique=True)
+    # Client side defaults too, columns added by db.add_missing_columns have no
+    # server default
+    time_created = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now())
+    time_updated = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now(), onupdate=func.now(), index=True)
+    # Natural key, used by idb.upsert_inventories
+    __table_args__ = (Index('uq_inventory_tile_id_exp_num', 'tile_id', 'exp_num',
+                            unique=True),)
 
     species = relationship("Species", back_populates="inventories")
     tile = relationship("Tile", back_populates="inventories")
@@ -50,7 +70,7 @@ class Inventory(Base):
                                back_populates="inventory")
 
     @classmethod
-    def from_geojson(cls, feature, session):
+    def from_geojson(cls, feature, session, species_ids=None, tile_ids=None):
         """Create an instance of Inventory from a geojson feature
 
         The feature must be a point with at least the following attributes.
@@ -59,33 +79,51 @@ class Inventory(Base):
         QUAL_CODE: Quality code
         EXPLOIT_NU: exploitation number
         PLACETTE: Name of the inventory tile
+
+        Species and tiles are looked up in the database (tiles are created when
+        missing) unless lookup dictionaries are provided
+
+        Args:
+            feature (dict): The geojson feature
+            session: sqlalchemy database session
+            species_ids (dict): Optional mapping of species codes to species ids
+            tile_ids (dict): Optional mapping of tile names to tile ids
         """
-        # Load Species object
-        sp = session.query(Species)\
-                .filter_by(code=feature['properties']['ESPE_CODE'])\
-                .first()
-        tile = get_or_create(session=session, model=Tile,
-                             name=feature['properties']['PLACETTE'])
-        geom = from_shape(shape(feature['geometry']), 4326)
-        return cls(geom=geom,
-                   species=sp,
-                   tile=tile,
+        point = shape(feature['geometry'])
+        if species_ids is not None and tile_ids is not None:
+            relations = {'species_id': species_ids.get(feature['properties']['ESPE_CODE']),
+                         'tile_id': tile_ids[feature['properties']['PLACETTE']]}
+        else:
+            # Load Species object
+            sp = session.query(Species)\
+                    .filter_by(code=feature['properties']['ESPE_CODE'])\
+                    .first()
+            tile = get_or_create(session=session, model=Tile,
+                                 name=feature['properties']['PLACETTE'])
+            relations = {'species': sp, 'tile': tile}
+        return cls(geom=from_shape(point, 4326),
+                   hilbert=hilbert_key(point.x, point.y),
+                   **relations,
                    quality=feature['properties'].get('QUAL_CODE', None),
                    exp_num=int(feature['properties']['EXPLOIT_NU']),
                    dbh=int(feature['properties']['CLAS_CODE']),
                    is_interpreted=False)
 
+    @property
+    def properties(self):
+        return {'species_name': self.species.name,
+                'species_code': self.species.code,
+                'species_id': self.species_id,
+                'quality': self.quality,
+                'dbh': self.dbh,
+                'is_interpreted': self.is_interpreted,
+                'comment': self.comment,
+                'id': self.id}
+
     @property
     def geojson(self):
         feature = {'type': 'Feature',
-                   'properties': {'species_name': self.species.name,
-                                  'species_code': self.species.code,
-                                  'species_id': self.species_id,
-                                  'quality': self.quality,
-                                  'dbh': self.dbh,
-                                  'is_interpreted': self.is_interpreted,
-                                  'comment': self.comment,
-                                  'id': self.id},
+                   'properties': self.properties,
                    'geometry': mapping(to_shape(self.geom))}
         return feature
 
@@ -97,7 +135,15 @@ class Interpreted(Base):
     geom = Column(Geometry(geometry_type='POLYGON', srid=4326, management=True))
     species_id = Column(Integer, ForeignKey('species.id'), index=True)
     inventory_id = Column(Integer, ForeignKey('inventory.id'))
-    time_created = Column(DateTime(timezone=True), server_default=func.now())
+    # Globally unique id, rows are matched on it by idb.sync
+    uid = Column(String(36), default=_uid, index=True,
+                 unique=True)
+    # Client side defaults too, columns added by db.add_missing_columns have no
+    # server default
+    time_created = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now())
+    time_updated = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now(), onupdate=func.now(), index=True)
 
     species = relationship("Species", back_populates="interpreted")
     inventory = relationship("Inventory", back_populates="interpreted")
@@ -117,15 +163,20 @@ class Interpreted(Base):
                    species_id=feature['properties']['species_id'],
                    inventory_id=feature['properties']['inventory_id'])
 
+    @property
+    def properties(self):
+        return {'species_id': self.species_id,
+                'species_name': self.species.name,
+                'species_code': self.species.code,
+                'inventory_id': self.inventory_id,
+                'time_created': self.time_created,
+                'time_updated': self.time_updated,
+                'id': self.id}
+
     @property
     def geojson(self):
         feature = {'type': 'Feature',
-                   'properties': {'species_id': self.species_id,
-                                  'species_name': self.species.name,
-                                  'species_code': self.species.code,
-                                  'inventory_id': self.inventory_id,
-                                  'time_created': self.time_created,
-                                  'id': self.id},
+                   'properties': self.properties,
                    'geometry': mapping(to_shape(self.geom))}
         return feature
 
@@ -160,11 +211,15 @@ class Studyarea(Base):
     geom = Column(Geometry(geometry_type='POLYGON', srid=4326, management=True))
     name = Column(String, unique=True)
 
+    @property
+    def properties(self):
+        return {'name': self.name,
+                'id': self.id}
+
     @property
     def geojson(self):
         feature = {'type': 'Feature',
-                   'properties': {'name': self.name,
-                                  'id': self.id},
+                   'properties': self.properties,
                    'geometry': mapping(to_shape(self.geom))}
         return feature
 
@@ -200,15 +255,28 @@ class Trainwindow(Base):
     geom = Column(Geometry(geometry_type='POLYGON', srid=4326, management=True))
     experiment_id = Column(Integer, ForeignKey('experiment.id'))
     complete = Column(Boolean) # Just a switch to help interpretation
+    # Globally unique id, rows are matched on it by idb.sync
+    uid = Column(String(36), default=_uid, index=True,
+                 unique=True)
+    # Client side defaults too, columns added by db.add_missing_columns have no
+    # server default
+    time_created = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now())
+    time_updated = Column(DateTime(timezone=True), default=func.now(),
+                          server_default=func.now(), onupdate=func.now(), index=True)
 
     experiment = relationship("Experiment", back_populates="trainwindows")
 
+    @property
+    def properties(self):
+        return {'id': self.id,
+                'experiment': self.experiment.name,
+                'complete': self.complete}
+
     @property
     def geojson(self):
         feature = {'type': 'Feature',
-                   'properties': {'id': self.id,
-                                  'experiment': self.experiment.name,
-                                  'complete': self.complete},
+                   'properties': self.properties,
                    'geometry': mapping(to_shape(self.geom))}
         return feature
 
@@ -220,3 +288,59 @@ class Trainwindow(Base):
                    complete=feature['properties']['complete'])
 
 
+class Progress(Base):
+    """Interpretation progress statistics
+
+    One row per species x tile x study area combination, maintained incrementally
+    by the idb write functions (see idb.stats). Rows with a null ``studyarea_id``
+    hold the totals of the whole tile, regardless of study areas
+    """
+    __tablename__ = 'progress'
+    id = Column(Integer, primary_key=True)
+    species_id = Column(Integer, ForeignKey('species.id'), index=True)
+    tile_id = Column(Integer, ForeignKey('tile.id'), index=True, nullable=True)
+    studyarea_id = Column(Integer, ForeignKey('studyarea.id'), index=True,
+                          nullable=True)
+    total = Column(Integer, default=0) # Number of inventory records
+    interpreted = Column(Integer, default=0) # Records with is_interpreted set to True
+    interpreted_polygons = Column(Integer, default=0) # Linked Interpreted rows
+
+# Key of the progress rows, null ids comparing equal. Conflict target of the
+# increments of idb.stats
+PROGRESS_KEY = [func.coalesce(Progress.species_id, literal_column('-1')),
+                func.coalesce(Progress.tile_id, literal_column('-1')),
+                func.coalesce(Progress.studyarea_id, literal_column('-1'))]
+Index('uq_progress_key', *PROGRESS_KEY, unique=True)
+
+
+class Tombstone(Base):
+    """Record of a deleted row of a change tracked table (see idb.sync)
+    """
+    __tablename__ = 'tombstone'
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, index=True)
+    row_id = Column(Integer)
+    row_uid = Column(String(36))
+    time_deleted = Column(DateTime(timezone=True), server_default=func.now(),
+                          index=True)
+
+
+class Cursor(Base):
+    """Named timestamp cursors, e.g. last synchronization between two envs
+    """
+    __tablename__ = 'cursor'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
+    value = Column(DateTime(timezone=True))
+
+
+def _record_deletion(mapper, connection, target):
+    connection.execute(Tombstone.__table__.insert()\
+                       .values(table_name=target.__tablename__,
+                               row_id=target.id,
+                               row_uid=target.uid))
+
+# Deletions done through the ORM (session.delete) are recorded; bulk deletes
+# (Query.delete, sql) bypass these listeners
+for model in [Inventory, Interpreted, Trainwindow]:
+    listen(model, 'after_delete', _record_deletion)
@@ -0,0 +1,129 @@
+"""Quality assessment of the interpreted crowns
+
+Overlapping pairs of interpreted polygons are found with a single spatial self
+join of the interpreted table (using its spatial index) rather than by checking
+features one by one. Invalid geometries are reported separately and excluded
+from the overlap search, since intersections cannot be computed on them.
+"""
+from sqlalchemy import exists, not_
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import func, cast, and_, or_
+from geoalchemy2 import Geography
+from geoalchemy2.shape import to_shape
+from shapely.geometry import mapping
+
+from idb.models import Interpreted, Trainwindow, Studyarea
+
+
+def _last_change(model):
+    return func.coalesce(model.time_updated, model.time_created)
+
+
+def _scope(model, experiment_id=None, study_area_id=None):
+    """Condition on interpreted polygons intersecting an experiment or a study area
+
+    Returns None when there is no restriction
+    """
+    clauses = []
+    if experiment_id is not None:
+        clauses.append(exists().where(and_(Trainwindow.experiment_id == experiment_id,
+                                           Trainwindow.geom.ST_Intersects(model.geom))))
+    if study_area_id is not None:
+        clauses.append(exists().where(and_(Studyarea.id == study_area_id,
+                                           Studyarea.geom.ST_Intersects(model.geom))))
+    return and_(*clauses) if clauses else None
+
+
+def _restrict(query, model, experiment_id=None, study_area_id=None):
+    """Restrict interpreted polygons to an experiment or a study area"""
+    scope = _scope(model, experiment_id, study_area_id)
+    return query if scope is None else query.filter(scope)
+
+
+def overlaps(session, experiment_id=None, study_area_id=None, since=None):
+    """Find pairs of overlapping interpreted polygons
+
+    Polygons whose interiors intersect are reported; polygons only sharing a
+    boundary are not
+
+    Args:
+        session: sqlalchemy database session
+        experiment_id (int): Optionally restrict to pairs where at least one
+            polygon intersects the training windows of an experiment
+        study_area_id (int): Optionally restrict to pairs where at least one
+            polygon intersects a study area
+        since (datetime.datetime): Only report pairs where at least one of the
+            polygons was created or updated after that time
+
+    Return:
+        list: List of features; the geometry is the intersection of the pair, the
+            properties contain ``type`` ('overlap'), ``id_a``, ``id_b``,
+            ``species_id_a``, ``species_id_b`` and ``overlap_area`` (m2)
+    """
+    a = aliased(Interpreted)
+    b = aliased(Interpreted)
+    intersection = a.geom.ST_Intersection(b.geom)
+    if session.get_bind().dialect.name == 'postgresql':
+        area = cast(intersection, Geography).ST_Area()
+    else:
+        # Spatialite has no geography type, area on the ellipsoid
+        area = func.ST_Area(intersection, 1)
+    q = session.query(a.id, b.id, a.species_id, b.species_id,
+                      intersection.label('geom'), area.label('area'))\
+            .join(b, and_(a.id < b.id,
+                          a.geom.ST_Intersects(b.geom),
+                          a.geom.ST_Relate(b.geom, '2********')))\
+            .filter(a.geom.ST_IsValid(), b.geom.ST_IsValid())
+    # Pairs are ordered by id, either polygon may be the one in scope
+    scope_a = _scope(a, experiment_id, study_area_id)
+    if scope_a is not None:
+        q = q.filter(or_(scope_a, _scope(b, experiment_id, study_area_id)))
+    if since is not None:
+        q = q.filter(or_(_last_change(a) > since, _last_change(b) > since))
+    return [{'type': 'Feature',
+             'properties': {'type': 'overlap',
+                            'id_a': id_a,
+                            'id_b': id_b,
+                            'species_id_a': sp_a,
+                            'species_id_b': sp_b,
+                            'overlap_area': area},
+             'geometry': mapping(to_shape(geom))}
+            for id_a, id_b, sp_a, sp_b, geom, area in q]
+
+
+def invalid(session, experiment_id=None, study_area_id=None, since=None):
+    """Find interpreted polygons with invalid geometries
+
+    See ``overlaps`` for the arguments
+
+    Return:
+        list: List of features with properties ``type`` ('invalid'), ``id``,
+            ``species_id`` and ``reason`` (see ST_IsValidReason)
+    """
+    q = session.query(Interpreted.id, Interpreted.species_id, Interpreted.geom,
+                      Interpreted.geom.ST_IsValidReason())\
+            .filter(not_(Interpreted.geom.ST_IsValid()))
+    q = _restrict(q, Interpreted, experiment_id, study_area_id)
+    if since is not None:
+        q = q.filter(_last_change(Interpreted) > since)
+    return [{'type': 'Feature',
+             'properties': {'type': 'invalid',
+                            'id': id,
+                            'species_id': species_id,
+                            'reason': reason},
+             'geometry': mapping(to_shape(geom))}
+            for id, species_id, geom, reason in q]
+
+
+def check(session, experiment_id=None, study_area_id=None, since=None):
+    """Run all quality checks on the interpreted polygons
+
+    See ``overlaps`` for the arguments
+
+    Return:
+        dict: A feature collection of the overlaps and invalid geometries found
+    """
+    kwargs = {'experiment_id': experiment_id, 'study_area_id': study_area_id,
+              'since': since}
+    return {'type': 'FeatureCollection',
+            'features': invalid(session, **kwargs) + overlaps(session, **kwargs)}
@@ -5,7 +5,7 @@ import argparse
 from sqlalchemy.orm.session import make_transient
 
 from idb.db import session_scope
-from idb.models import Tile, Studyarea, Species, Inventory, Interpreted
+from idb.models import Tile, Studyarea, Species, Inventory, Interpreted, Progress
 
 
 
@@ -47,7 +47,7 @@ Example:
             for obj in all_obj:
                 session.merge(obj)
 
-    for table in [Species, Tile, Studyarea, Inventory, Interpreted]:
+    for table in [Species, Tile, Studyarea, Inventory, Interpreted, Progress]:
         transfer_table(table, src_env, dst_env)
 
 
@@ -4,6 +4,7 @@ import argparse
 import csv
 
 from idb.db import init_db, session_scope
+from idb.indexes import missing_indexes, maintain, cluster
 from idb.models import Species
 from idb.utils import get_or_create
 
@@ -31,6 +32,18 @@ Example:
     # that will take care of setting up the tables and relations
 
     db_init.py --env sqlite
+
+    ###########
+    ## Database maintenance
+    ###########
+
+    # Refresh planner statistics (ANALYZE), optionally reclaim space (VACUUM)
+    # and report indexes that are missing or have never been used
+    db_init.py --env main maintain --vacuum
+
+    # Store inventory records in the order of their Hilbert key, so that
+    # spatially close records share pages (locks the inventory table)
+    db_init.py --env main cluster
 """
 
 
@@ -49,11 +62,35 @@ Example:
                         type=str,
                         help='env to use (database), as defined in the .idb file')
 
+    subparsers = parser.add_subparsers(dest='command')
+    maintain_parser = subparsers.add_parser('maintain',
+                                            help='Run ANALYZE/VACUUM and report missing or unused indexes')
+    maintain_parser.add_argument('--vacuum',
+                                 action='store_true',
+                                 help='Also run VACUUM (locks tables on sqlite)')
+    subparsers.add_parser('cluster',
+                          help='Compute missing Hilbert keys and cluster the inventory table on them')
+
     parsed_args = parser.parse_args()
 
     csv_path = vars(parsed_args)['species']
     env = vars(parsed_args)['env']
+
+    if vars(parsed_args)['command'] == 'maintain':
+        report = maintain(env=env, vacuum=vars(parsed_args)['vacuum'])
+        print('Missing indexes (create with db_init.py): %s' % (', '.join(report['missing']) or 'none'))
+        print('Unused indexes: %s' % (', '.join(report['unused']) or 'none'))
+        parser.exit()
+
+    if vars(parsed_args)['command'] == 'cluster':
+        n_keys = cluster(env=env)
+        print('Hilbert keys computed: %d, inventory table clustered' % n_keys)
+        parser.exit()
+
     init_db(env=env)
+    missing = missing_indexes(env=env)
+    if missing:
+        print('Warning, indexes could not be created: %s' % ', '.join(missing))
 
     if csv_path is not None:
         with open(csv_path) as src:
@@ -5,7 +5,7 @@ import argparse
 import fiona
 
 from idb.db import session_scope
-from idb import add_inventories
+from idb import add_inventories, upsert_inventories, stats
 from idb.models import Tile, Studyarea
 
 
@@ -22,6 +22,9 @@ with the --species flag)
 
 Example:
     ingest_inventory.py inventory.gpkg --env main
+
+    # Re-ingest a corrected version of the same inventory, updating changed records
+    ingest_inventory.py inventory.gpkg --env main --upsert
 """
     parser = argparse.ArgumentParser(epilog=epilog,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -36,25 +39,46 @@ Example:
                         type=str,
                         help='env to use (database), as defined in the .idb file')
 
+    parser.add_argument('-u', '--upsert',
+                        action='store_true',
+                        help='Insert or update records keyed on (tile, exploitation number) instead of always inserting')
+
     parsed_args = parser.parse_args()
 
     gpkg_file = vars(parsed_args)['inventory']
     env = vars(parsed_args)['env']
+    upsert = vars(parsed_args)['upsert']
 
-# Add tiles
+# Add tiles (existing tiles are skipped when upserting)
 with fiona.open(gpkg_file, layer='tiles') as src:
     tile_list = [Tile.from_geojson(feature) for feature in src]
 with session_scope(env=env) as session:
+    session.use_primary()
+    if upsert:
+        existing = {x[0] for x in session.query(Tile.name)}
+        tile_list = [x for x in tile_list if x.name not in existing]
     session.add_all(tile_list)
 
-# Add inventory samples
-with fiona.open(gpkg_file, layer='inventory') as src:
-    with session_scope(env=env) as session:
-        add_inventories(session, list(src))
-
-# Add study area
+# Add study area, before the inventory so that progress statistics of the new
+# records are tracked per study area. Records already in the database are added
+# to the totals of the new study areas
 with fiona.open(gpkg_file, layer='studyarea') as src:
     studyarea_list = [Studyarea.from_geojson(feature) for feature in src]
 with session_scope(env=env) as session:
+    session.use_primary()
+    if upsert:
+        existing = {x[0] for x in session.query(Studyarea.name)}
+        studyarea_list = [x for x in studyarea_list if x.name not in existing]
     session.add_all(studyarea_list)
+    session.flush()
+    stats.add_studyareas(session, [x.id for x in studyarea_list])
 
+# Add inventory samples
+with fiona.open(gpkg_file, layer='inventory') as src:
+    with session_scope(env=env) as session:
+        if upsert:
+            counts = upsert_inventories(session, list(src))
+            print('%d records inserted, %d updated, %d unchanged'
+                  % (counts['inserted'], counts['updated'], counts['unchanged']))
+        else:
+            add_inventories(session, list(src))
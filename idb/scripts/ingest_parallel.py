@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from idb.ingest import ingest_files
+
+
+if __name__ == '__main__':
+    epilog = """
+Ingest several inventory files into the database using a pool of worker processes.
+Each file must follow the layout expected by ingest_inventory.py (layers 'tiles',
+'inventory' and 'studyarea'). Tiles and study areas are ingested first, inventory
+layers are then split in chunks that are processed in parallel
+
+List of species must have been ingested previously (e.g. using the db_init command
+with the --species flag)
+
+Example:
+    ingest_parallel.py concessions/*.gpkg --env main --processes 8
+"""
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('inventories',
+                        type=str,
+                        nargs='+',
+                        help='Multilayer geospatial vector files containing the inventory data')
+
+    parser.add_argument('-env', '--env',
+                        required=False,
+                        default='main',
+                        type=str,
+                        help='env to use (database), as defined in the .idb file')
+
+    parser.add_argument('-p', '--processes',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help='Number of worker processes (defaults to the number of CPUs)')
+
+    parser.add_argument('-c', '--chunk-size',
+                        required=False,
+                        default=5000,
+                        type=int,
+                        help='Maximum number of inventory features per task')
+
+    parser.add_argument('-u', '--upsert',
+                        action='store_true',
+                        help='Insert or update records keyed on (tile, exploitation number) instead of always inserting')
+
+    parsed_args = parser.parse_args()
+
+    paths = vars(parsed_args)['inventories']
+    env = vars(parsed_args)['env']
+
+    done = []
+    def progress(result):
+        done.append(result)
+        status = 'ERROR %s' % result['error'] if result['error'] else '%d records' % result['n']
+        print('[%d] %s [%d:%d] %s' % (len(done), result['path'], result['start'],
+                                      result['stop'], status))
+
+    report = ingest_files(paths, env=env,
+                          processes=vars(parsed_args)['processes'],
+                          chunk_size=vars(parsed_args)['chunk_size'],
+                          upsert=vars(parsed_args)['upsert'],
+                          callback=progress)
+
+    print('%d records processed from %d files (%d chunks), %d failed chunks'
+          % (report['processed'], len(paths), report['chunks'], len(report['errors'])))
+    for error in report['errors']:
+        print('  %s [%d:%d] %s' % (error['path'], error['start'], error['stop'],
+                                   error['error']))
+    if report['errors']:
+        sys.exit(1)
+
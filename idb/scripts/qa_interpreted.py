@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from sqlalchemy.sql import func
+
+from idb.db import session_scope
+from idb.models import Cursor
+from idb import qa
+
+
+if __name__ == '__main__':
+    epilog = """
+Find overlapping pairs of interpreted polygons and interpreted polygons with invalid
+geometries, and write them to a geojson file. Overlap features have the geometry of
+the intersection and an overlap_area property (m2)
+
+With --incremental, only polygons created or updated since the previous incremental
+run with the same restrictions are checked (the time of the run is stored in the
+database)
+
+Example:
+    qa_interpreted.py --experiment 1 -o qa.geojson
+    qa_interpreted.py --study-area 2 --incremental -o qa_new.geojson
+"""
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-e', '--experiment',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help='Restrict to polygons intersecting the windows of this experiment id')
+
+    parser.add_argument('-s', '--study-area',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help='Restrict to polygons intersecting this study area id')
+
+    parser.add_argument('-i', '--incremental',
+                        action='store_true',
+                        help='Only check polygons created or updated since the last incremental run')
+
+    parser.add_argument('-o', '--output',
+                        required=True,
+                        type=str,
+                        help='Output geojson file')
+
+    parser.add_argument('-env', '--env',
+                        required=False,
+                        default='main',
+                        type=str,
+                        help='env to use (database), as defined in the .idb file')
+
+    parsed_args = parser.parse_args()
+
+    experiment_id = vars(parsed_args)['experiment']
+    study_area_id = vars(parsed_args)['study_area']
+    env = vars(parsed_args)['env']
+
+    cursor_name = 'qa:experiment:%s:studyarea:%s' % (experiment_id, study_area_id)
+    with session_scope(env=env) as session:
+        run_start = session.query(func.now()).scalar()
+        cursor = None
+        since = None
+        if vars(parsed_args)['incremental']:
+            cursor = session.query(Cursor).filter_by(name=cursor_name).first()
+            if cursor is None:
+                cursor = Cursor(name=cursor_name)
+                session.add(cursor)
+            since = cursor.value
+        fc = qa.check(session, experiment_id=experiment_id,
+                      study_area_id=study_area_id, since=since)
+        if cursor is not None:
+            cursor.value = run_start
+
+    with open(vars(parsed_args)['output'], 'w') as dst:
+        json.dump(fc, dst, default=str)
+
+    n_invalid = len([x for x in fc['features'] if x['properties']['type'] == 'invalid'])
+    print('%d invalid geometries, %d overlapping pairs'
+          % (n_invalid, len(fc['features']) - n_invalid))
+
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from idb.db import session_scope
+from idb import stats
+from idb.indexes import create_indexes
+
+
+if __name__ == '__main__':
+    epilog = """
+Fully rebuild the interpretation progress statistics table
+
+The table is normally kept up to date by the idb functions writing to the inventory
+and interpreted tables. A full rebuild is required after ingesting new study areas,
+or after modifying these tables by other means (e.g. copy_db.py, manual SQL).
+The rebuild also removes duplicated rows left by older versions of idb, after which
+the unique index of the table is created
+
+Example:
+    rebuild_progress.py --env main
+"""
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-env', '--env',
+                        required=False,
+                        default='main',
+                        type=str,
+                        help='env to use (database), as defined in the .idb file')
+
+    parsed_args = parser.parse_args()
+
+    env = vars(parsed_args)['env']
+
+    with session_scope(env=env) as session:
+        stats.rebuild(session)
+    create_indexes(env=env)
+
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from idb.sync import sync
+
+
+if __name__ == '__main__':
+    epilog = """
+Incrementally synchronize two databases. Only the inventory, interpreted and
+trainwindow rows changed (or deleted) since the previous synchronization are
+transferred; reference tables (species, tiles, study areas, experiments) are copied
+in full. Both databases must already exist (e.g. create with db_init.py), the
+first run transfers everything (equivalent to copy_db.py)
+
+When a row was modified in both databases, the most recent modification wins.
+A row deleted in the source but modified afterwards in the destination is kept
+
+Example:
+    # Update the field copy with the changes of the main database
+    sync_db.py --src-env main --dst-env sqlite
+
+    # Two way synchronization
+    sync_db.py --src-env main --dst-env sqlite --both
+"""
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-src-env', '--src-env',
+                        required=True,
+                        type=str,
+                        help='source env to use (database), as defined in the .idb file')
+
+    parser.add_argument('-dst-env', '--dst-env',
+                        required=True,
+                        type=str,
+                        help='destination env to use (database), as defined in the .idb file')
+
+    parser.add_argument('-b', '--both',
+                        action='store_true',
+                        help='Also synchronize the destination changes back to the source')
+
+    parsed_args = parser.parse_args()
+
+    src_env = vars(parsed_args)['src_env']
+    dst_env = vars(parsed_args)['dst_env']
+
+    directions = [(src_env, dst_env)]
+    if vars(parsed_args)['both']:
+        directions.append((dst_env, src_env))
+
+    for src, dst in directions:
+        report = sync(src, dst)
+        print('%s -> %s' % (src, dst))
+        for table, n in report['updated'].items():
+            print('  %s: %d rows written, %d rows deleted'
+                  % (table, n, report['deleted'].get(table, 0)))
+        for table, id in report['conflicts']:
+            print('  conflict: %s %d kept in %s (more recent)' % (table, id, dst))
+
@@ -0,0 +1,212 @@
+"""In memory snapshot of the inventory table
+
+The inventory is loaded into compact numpy columns and indexed with a regular
+grid (records sorted by grid cell, so that the records of a range of cells are
+contiguous). Radius, neighbourhood, species and sampling queries are answered
+with vectorized numpy operations, without database round trips. Snapshots can be
+saved to a directory of ``.npy`` files and loaded back memory mapped.
+
+Distances are computed on a sphere (haversine), which differs slightly from the
+spheroid computations of postgis' geography type.
+"""
+import json
+import os
+
+import numpy as np
+
+from idb.models import Inventory
+
+
+EARTH_RADIUS = 6371008.8 # Mean earth radius, in meters
+
+COLUMNS = {'id': np.int64,
+           'lon': np.float64,
+           'lat': np.float64,
+           'species_id': np.int32, # -1 when null
+           'dbh': np.int32, # -1 when null
+           'tile_id': np.int32, # -1 when null
+           'is_interpreted': np.bool_}
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Great circle distance in meters (vectorized)"""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2\
+            + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class InventorySnapshot(object):
+    """Inventory columns with a grid spatial index
+
+    Args:
+        columns (dict): Arrays of the inventory columns (see ``COLUMNS``)
+        cell_size (float): Size of the grid cells, in degrees
+        index (dict): Optional precomputed index arrays (``order``, ``keys``)
+            and ``meta``, as written by ``save``
+
+    Example:
+        >>> from idb.db import session_scope
+        >>> from idb.snapshot import InventorySnapshot
+        >>> with session_scope() as session:
+        ...     snap = InventorySnapshot.from_db(session)
+        >>> snap.save('/tmp/inventory_snapshot')
+        >>> snap = InventorySnapshot.load('/tmp/inventory_snapshot')
+        >>> ids = snap.inventories(n_samples=10, species_id=3)
+    """
+    def __init__(self, columns, cell_size=0.01, index=None):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        if index is None:
+            self._build_index(cell_size)
+        else:
+            self.order = index['order']
+            self.keys = index['keys']
+            self.meta = index['meta']
+
+    @classmethod
+    def from_db(cls, session, cell_size=0.01):
+        """Load the inventory table of a database
+
+        Args:
+            session: sqlalchemy database session
+            cell_size (float): Size of the grid cells, in degrees
+        """
+        q = session.query(Inventory.id, Inventory.geom.ST_X(),
+                          Inventory.geom.ST_Y(), Inventory.species_id,
+                          Inventory.dbh, Inventory.tile_id,
+                          Inventory.is_interpreted)\
+                .order_by(Inventory.id)
+        rows = q.all()
+        columns = {}
+        for i, (name, dtype) in enumerate(COLUMNS.items()):
+            values = [row[i] for row in rows]
+            if name == 'is_interpreted':
+                values = [bool(v) for v in values]
+            elif dtype is np.int32:
+                values = [-1 if v is None else v for v in values]
+            columns[name] = np.asarray(values, dtype=dtype)
+        return cls(columns, cell_size=cell_size)
+
+    def _cells(self, lon, lat):
+        cx = np.floor((lon - self.meta['lon0']) / self.meta['cell_size']).astype(np.int64)
+        cy = np.floor((lat - self.meta['lat0']) / self.meta['cell_size']).astype(np.int64)
+        return cx, cy
+
+    def _build_index(self, cell_size):
+        lon0 = float(self.lon.min()) if len(self.lon) else 0.
+        lat0 = float(self.lat.min()) if len(self.lat) else 0.
+        ncols = int(np.floor((self.lon.max() - lon0) / cell_size)) + 1 if len(self.lon) else 1
+        nrows = int(np.floor((self.lat.max() - lat0) / cell_size)) + 1 if len(self.lat) else 1
+        self.meta = {'cell_size': cell_size, 'lon0': lon0, 'lat0': lat0,
+                     'ncols': ncols, 'nrows': nrows}
+        cx, cy = self._cells(self.lon, self.lat)
+        keys = cy * ncols + cx
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def save(self, path):
+        """Write the snapshot to a directory of .npy files"""
+        os.makedirs(path, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(path, '%s.npy' % name), getattr(self, name))
+        np.save(os.path.join(path, 'order.npy'), self.order)
+        np.save(os.path.join(path, 'keys.npy'), self.keys)
+        with open(os.path.join(path, 'meta.json'), 'w') as dst:
+            json.dump(self.meta, dst)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a snapshot written by ``save``, memory mapped by default"""
+        columns = {name: np.load(os.path.join(path, '%s.npy' % name),
+                                 mmap_mode=mmap_mode) for name in COLUMNS}
+        with open(os.path.join(path, 'meta.json')) as src:
+            meta = json.load(src)
+        index = {'order': np.load(os.path.join(path, 'order.npy'), mmap_mode=mmap_mode),
+                 'keys': np.load(os.path.join(path, 'keys.npy'), mmap_mode=mmap_mode),
+                 'meta': meta}
+        return cls(columns, index=index)
+
+    def _position(self, inventory_id):
+        """Row position of an inventory id (ids are sorted by from_db)"""
+        pos = np.searchsorted(self.id, inventory_id)
+        if pos >= len(self.id) or self.id[pos] != inventory_id:
+            raise KeyError(inventory_id)
+        return pos
+
+    def _filter(self, idx, species_id=None, is_interpreted=None):
+        if species_id is not None:
+            idx = idx[np.isin(self.species_id[idx], np.atleast_1d(species_id))]
+        if is_interpreted is not None:
+            idx = idx[self.is_interpreted[idx] == is_interpreted]
+        return idx
+
+    def within(self, lon, lat, radius):
+        """Row positions of the records within radius (meters) of a point"""
+        if not len(self.id):
+            return np.array([], dtype=np.int64)
+        dlat = np.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        cx0, cy0 = self._cells(lon - dlon, lat - dlat)
+        cx1, cy1 = self._cells(lon + dlon, lat + dlat)
+        cx0, cx1 = max(cx0, 0), min(cx1, self.meta['ncols'] - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, self.meta['nrows'] - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.array([], dtype=np.int64)
+        # Cells of a grid row are contiguous in the sorted keys
+        row_keys = np.arange(cy0, cy1 + 1) * self.meta['ncols']
+        starts = np.searchsorted(self.keys, row_keys + cx0, side='left')
+        stops = np.searchsorted(self.keys, row_keys + cx1, side='right')
+        idx = np.concatenate([self.order[a:b] for a, b in zip(starts, stops)])
+        dist = haversine(lon, lat, self.lon[idx], self.lat[idx])
+        return np.sort(idx[dist <= radius])
+
+    def inventories(self, n_samples=None, species_id=None, is_interpreted=False,
+                    spatial_filter=None, random_state=None):
+        """Filter and sample the inventory, see ``idb.inventories``
+
+        Args:
+            n_samples (int): Number of samples (no limit if None (default))
+            species_id (int): Optional Species id (or list of ids)
+            is_interpreted (bool): Filter on ``is_interpreted``, None for no
+                filtering
+            spatial_filter (dict): Dictionary with keys ``lon``, ``lat`` and
+                ``radius`` (meters)
+            random_state: Seed or numpy random Generator used for sampling
+
+        Returns:
+            numpy.ndarray: Inventory ids, in random order
+        """
+        if spatial_filter is not None:
+            idx = self.within(spatial_filter['lon'], spatial_filter['lat'],
+                              spatial_filter['radius'])
+        else:
+            idx = np.arange(len(self.id))
+        idx = self._filter(idx, species_id=species_id,
+                           is_interpreted=is_interpreted)
+        rng = np.random.default_rng(random_state)
+        n = len(idx) if n_samples is None else min(n_samples, len(idx))
+        return self.id[rng.choice(idx, size=n, replace=False)]
+
+    def inventories_hits(self, species_id=None, is_interpreted=False,
+                         spatial_filter=None):
+        """Number of records matching the filters, see ``inventories``"""
+        if spatial_filter is not None:
+            idx = self.within(spatial_filter['lon'], spatial_filter['lat'],
+                              spatial_filter['radius'])
+        else:
+            idx = np.arange(len(self.id))
+        return len(self._filter(idx, species_id=species_id,
+                                is_interpreted=is_interpreted))
+
+    def neighborhood(self, inventory_id, distance, species_id=None):
+        """Ids of the records within distance (meters) of an inventory record
+
+        The record itself is excluded, see ``idb.neighborhood``
+        """
+        pos = self._position(inventory_id)
+        idx = self.within(self.lon[pos], self.lat[pos], distance)
+        idx = idx[idx != pos]
+        return self.id[self._filter(idx, species_id=species_id)]
+
+    neighbourhood = neighborhood
@@ -0,0 +1,183 @@
+"""Incremental maintenance of the interpretation progress statistics
+
+The ``progress`` table holds, for every species x tile x study area combination,
+the number of inventory records, how many of them are interpreted and how many
+Interpreted polygons are linked to them. Rather than recounting the inventory,
+write operations remove the contribution of the inventory records they touch
+before modifying them and add it back afterwards (see ``tracking``).
+"""
+from contextlib import contextmanager
+
+from sqlalchemy.sql.expression import func, case
+
+from idb.models import Inventory, Interpreted, Studyarea, Progress, PROGRESS_KEY
+
+
+# Maximum number of inventory ids per query. Ids are used in two IN lists per
+# query, this keeps the number of parameters below the default sqlite limit
+# (999)
+CHUNK_SIZE = 400
+
+
+def _contributions(session, inventory_ids=None, studyarea_ids=None):
+    """Aggregate counts of a set of inventory records per progress key
+
+    Large sets of ids are aggregated in chunks of ``CHUNK_SIZE``
+
+    Args:
+        session: sqlalchemy database session
+        inventory_ids (iterable): Inventory ids to aggregate. All records of the
+            inventory table are aggregated when None
+        studyarea_ids (iterable): Optionally only aggregate the totals of these
+            study areas (whole tile totals are then left out)
+
+    Returns:
+        dict: Mapping of (species_id, tile_id, studyarea_id) tuples to
+            (total, interpreted, interpreted_polygons) tuples
+    """
+    if inventory_ids is not None:
+        inventory_ids = list(inventory_ids)
+        if len(inventory_ids) > CHUNK_SIZE:
+            out = {}
+            for i in range(0, len(inventory_ids), CHUNK_SIZE):
+                chunk = _contributions(session, inventory_ids[i:i + CHUNK_SIZE],
+                                       studyarea_ids)
+                for key, counts in chunk.items():
+                    out[key] = tuple((a or 0) + (b or 0) for a, b in
+                                     zip(out.get(key, (0, 0, 0)), counts))
+            return out
+    polygons = session.query(Interpreted.inventory_id.label('inventory_id'),
+                             func.count(Interpreted.id).label('n'))\
+            .group_by(Interpreted.inventory_id)
+    if inventory_ids is not None:
+        polygons = polygons.filter(Interpreted.inventory_id.in_(inventory_ids))
+    polygons = polygons.subquery()
+    columns = [func.count(Inventory.id),
+               func.sum(case([(Inventory.is_interpreted, 1)], else_=0)),
+               func.sum(func.coalesce(polygons.c.n, 0))]
+    # Whole tile totals, stored with a null studyarea_id
+    q_tile = session.query(Inventory.species_id, Inventory.tile_id, *columns)\
+            .outerjoin(polygons, polygons.c.inventory_id == Inventory.id)\
+            .group_by(Inventory.species_id, Inventory.tile_id)
+    # Totals per study area
+    q_area = session.query(Inventory.species_id, Inventory.tile_id,
+                           Studyarea.id, *columns)\
+            .join(Studyarea, Inventory.geom.ST_Intersects(Studyarea.geom))\
+            .outerjoin(polygons, polygons.c.inventory_id == Inventory.id)\
+            .group_by(Inventory.species_id, Inventory.tile_id, Studyarea.id)
+    if inventory_ids is not None:
+        q_tile = q_tile.filter(Inventory.id.in_(inventory_ids))
+        q_area = q_area.filter(Inventory.id.in_(inventory_ids))
+    out = {}
+    if studyarea_ids is not None:
+        q_area = q_area.filter(Studyarea.id.in_(list(studyarea_ids)))
+    else:
+        out.update({(sp, tile, None): (n, n_int, n_poly)
+                    for sp, tile, n, n_int, n_poly in q_tile})
+    out.update({(sp, tile, area): (n, n_int, n_poly)
+                for sp, tile, area, n, n_int, n_poly in q_area})
+    return out
+
+
+def _sort_key(item):
+    return tuple((x is None, x or 0) for x in item[0])
+
+
+def _rows(contributions, sign=1):
+    """Progress rows (list of dict) of a contributions dict
+
+    Rows are sorted by key (None last), so that concurrent writers lock the
+    progress rows in the same order and cannot deadlock
+    """
+    rows = []
+    for (species_id, tile_id, studyarea_id), counts in sorted(contributions.items(),
+                                                              key=_sort_key):
+        total, interpreted, polygons = [sign * (x or 0) for x in counts]
+        rows.append({'species_id': species_id, 'tile_id': tile_id,
+                     'studyarea_id': studyarea_id, 'total': total,
+                     'interpreted': interpreted,
+                     'interpreted_polygons': polygons})
+    return rows
+
+
+def _increment_statement(session):
+    """Build an INSERT ... ON CONFLICT statement incrementing the counters of a
+    progress row, created when it does not exist"""
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = Progress.__table__
+    stmt = insert(table)
+    counters = ['total', 'interpreted', 'interpreted_polygons']
+    return stmt.on_conflict_do_update(index_elements=PROGRESS_KEY,
+                                      set_={c: table.c[c] + stmt.excluded[c]
+                                            for c in counters})
+
+
+def _apply(session, contributions, sign=1):
+    """Add (sign=1) or subtract (sign=-1) contributions to the progress table
+
+    Counters are incremented in sql (``total = total + n``), rows being created
+    or incremented atomically on the ``uq_progress_key`` unique index, so that
+    concurrent writers (e.g. parallel ingest workers) neither overwrite each
+    other nor create duplicated rows. Requires, for sqlite, sqlalchemy >= 1.4
+    """
+    if contributions:
+        session.execute(_increment_statement(session), _rows(contributions, sign))
+
+
+@contextmanager
+def tracking(session, inventory_ids=()):
+    """Keep the progress table in sync around a write operation
+
+    The contribution of the given inventory records is removed on entry and
+    added back on exit, after flushing the session. Ids of records that do not
+    exist yet (e.g. inserted within the block) can be added to the yielded set
+
+    Example:
+        >>> with tracking(session, [12]) as ids:
+        ...     session.query(Inventory).filter_by(id=12).update({'is_interpreted': True})
+    """
+    # Counts read before the write must not come from a lagging read replica
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    ids = {x for x in inventory_ids if x is not None}
+    if ids:
+        _apply(session, _contributions(session, ids), -1)
+    yield ids
+    session.flush()
+    ids = {x for x in ids if x is not None}
+    if ids:
+        _apply(session, _contributions(session, ids), 1)
+
+
+def add_studyareas(session, studyarea_ids):
+    """Add the records already in the inventory to the totals of new study areas
+
+    To be called after inserting study areas (and flushing the session),
+    instead of a full rebuild
+
+    Args:
+        session: sqlalchemy database session
+        studyarea_ids (iterable): Ids of the new study areas
+    """
+    if hasattr(session, 'use_primary'):
+        session.use_primary()
+    studyarea_ids = list(studyarea_ids)
+    if studyarea_ids:
+        _apply(session, _contributions(session, studyarea_ids=studyarea_ids), 1)
+
+
+def rebuild(session):
+    """Recompute the whole progress table from the inventory
+
+    Required after ingesting or modifying study areas, or after writing to the
+    inventory and interpreted tables without going through the idb functions
+    """
+    session.query(Progress).delete(synchronize_session=False)
+    # Keys are unique, plain inserts do not require the unique index (missing
+    # on databases with duplicated rows, see rebuild_progress.py)
+    rows = _rows(_contributions(session))
+    if rows:
+        session.execute(Progress.__table__.insert(), rows)
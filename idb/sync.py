@@ -0,0 +1,262 @@
+"""Incremental synchronization between two environments
+
+Rows of the change tracked tables (Inventory, Interpreted, Trainwindow) are
+transferred when their ``time_updated`` is more recent than the cursor stored in
+the destination database for that source and table. Deletions are propagated
+from the ``tombstone`` table. Reference tables (Species, Tile, Studyarea,
+Experiment) are small and copied in full at every run.
+
+Rows of the change tracked tables are matched on their ``uid`` column (a uuid
+set at creation), not on their primary key: rows created independently in two
+envs may share an id. Rows are inserted with the id of the destination and
+foreign keys to the inventory are translated. Rows created before the ``uid``
+column existed get a uid derived from their table and id, so that they keep
+being matched on their id as before. Reference tables are matched on their
+primary key. Conflicts are resolved as follows:
+
+- A row modified in both environments since the last run: the most recent
+  ``time_updated`` wins (the destination row is kept if it is newer)
+- A row deleted in the source and modified in the destination after the
+  deletion: the modification wins and the row is kept
+"""
+import datetime as dt
+import uuid
+
+from sqlalchemy.sql import func, or_, bindparam, text
+from sqlalchemy.orm import make_transient
+
+from idb.db import session_scope, engines
+from idb.models import Species, Tile, Studyarea, Experiment
+from idb.models import Inventory, Interpreted, Trainwindow, Tombstone, Cursor
+from idb import stats
+
+
+# Parent tables first (inserts), children first for deletes
+REFERENCE_TABLES = [Species, Tile, Studyarea, Experiment]
+TRACKED_TABLES = [Inventory, Interpreted, Trainwindow]
+
+# Rows changed shortly before the cursor are read again, to catch transactions
+# that committed after a previous run despite an older timestamp. Rows already
+# transferred are detected (identical time_updated) and skipped
+SAFETY_MARGIN = dt.timedelta(minutes=5)
+
+# Maximum number of values per IN list
+CHUNK_SIZE = 500
+
+
+def _utc(value):
+    """Make a datetime timezone aware (naive values, e.g. from sqlite, are UTC)"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=dt.timezone.utc)
+    return value.astimezone(dt.timezone.utc)
+
+
+def _get_cursor(session, name):
+    cursor = session.query(Cursor).filter_by(name=name).first()
+    return None if cursor is None else _utc(cursor.value)
+
+
+def _set_cursor(session, name, value):
+    cursor = session.query(Cursor).filter_by(name=name).first()
+    if cursor is None:
+        session.add(Cursor(name=name, value=value))
+    else:
+        cursor.value = value
+
+
+def _legacy_uid(table_name, row_id):
+    """uid of a row created before the uid column existed"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, 'idb:%s:%d' % (table_name, row_id)))
+
+
+def _query_in(query, column, values):
+    """Rows of a query filtered on column IN values, run in chunks"""
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), CHUNK_SIZE):
+        rows.extend(query.filter(column.in_(values[i:i + CHUNK_SIZE])))
+    return rows
+
+
+def _backfill_uids(session, model):
+    """Set the uid of rows created before the uid column existed
+
+    time_updated is kept, the rows are not considered modified
+    """
+    table = model.__table__
+    ids = [x[0] for x in session.query(model.id).filter(model.uid.is_(None))]
+    if ids:
+        stmt = table.update()\
+                .where(table.c.id == bindparam('row_id'))\
+                .values(uid=bindparam('row_uid'), time_updated=table.c.time_updated)
+        session.execute(stmt, [{'row_id': id,
+                                'row_uid': _legacy_uid(table.name, id)}
+                               for id in ids])
+
+
+def _reset_sequences(session, models):
+    """Move postgres id sequences past the ids written explicitly"""
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__tablename__
+        session.execute(text("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                             "coalesce(max(id), 1), max(id) IS NOT NULL) FROM %s"
+                             % (table, table)))
+
+
+def _read_changes(session, model, since):
+    """Rows of model updated since a given time, tombstones of deleted rows and
+    uids of the inventory records referenced by the rows"""
+    rows = session.query(model)
+    tombstones = session.query(Tombstone)\
+            .filter_by(table_name=model.__tablename__)
+    if since is not None:
+        # Rows without timestamp (created before an upgrade of the database)
+        # are always read, and skipped by _apply_rows once transferred
+        rows = rows.filter(or_(model.time_updated >= since - SAFETY_MARGIN,
+                               model.time_updated.is_(None)))
+        tombstones = tombstones.filter(Tombstone.time_deleted >= since - SAFETY_MARGIN)
+    rows = rows.all()
+    tombstones = tombstones.all()
+    inventory_uids = {}
+    if model is Interpreted:
+        inventory_uids = dict(_query_in(session.query(Inventory.id, Inventory.uid),
+                                        Inventory.id,
+                                        {x.inventory_id for x in rows
+                                         if x.inventory_id is not None}))
+    session.expunge_all()
+    return rows, tombstones, inventory_uids
+
+
+def _apply_rows(session, model, rows, inventory_uids, report):
+    """Write source rows to the destination, resolving conflicts
+
+    Args:
+        inventory_uids (dict): Source inventory ids to uids, used to translate
+            the inventory_id of Interpreted rows
+    """
+    current = {x.uid: x for x in
+               _query_in(session.query(model.uid, model.id, model.time_updated),
+                         model.uid, {x.uid for x in rows})}
+    inventory_ids = {}
+    if model is Interpreted:
+        inventory_ids = {x.uid: x.id for x in
+                         _query_in(session.query(Inventory.uid, Inventory.id),
+                                   Inventory.uid, set(inventory_uids.values()))}
+    to_write = []
+    for row in rows:
+        row.time_updated = _utc(row.time_updated)
+        old = current.get(row.uid)
+        if old is not None:
+            if _utc(old.time_updated) == row.time_updated:
+                continue # Already transferred
+            if old.time_updated is not None and row.time_updated is not None\
+                    and _utc(old.time_updated) > row.time_updated:
+                report['conflicts'].append((model.__tablename__, old.id))
+                continue
+        # Destination id, None for new rows. The source identity of the row is
+        # dropped first, merge would otherwise look the row up by its source id
+        make_transient(row)
+        row.id = None if old is None else old.id
+        if model is Interpreted:
+            row.inventory_id = inventory_ids.get(inventory_uids.get(row.inventory_id))
+        to_write.append(row)
+    # Inventory ids whose progress statistics change
+    affected = set()
+    if model is Inventory:
+        affected.update(x.id for x in to_write)
+    elif model is Interpreted:
+        affected.update(x.inventory_id for x in to_write)
+        affected.update(x[0] for x in
+                        _query_in(session.query(Interpreted.inventory_id),
+                                  Interpreted.id,
+                                  {x.id for x in to_write if x.id is not None}))
+    with stats.tracking(session, affected) as ids:
+        # time_updated is explicitly set and therefore kept by the update
+        merged = [session.merge(row) for row in to_write]
+        session.flush()
+        if model is Inventory:
+            ids.update(x.id for x in merged)
+        elif model is Interpreted:
+            ids.update(x.inventory_id for x in merged)
+    report['updated'][model.__tablename__] = len(to_write)
+
+
+def _apply_deletes(session, model, tombstones, report):
+    """Delete rows from the destination, unless modified after their deletion"""
+    deleted = 0
+    for tombstone in tombstones:
+        uid = tombstone.row_uid or _legacy_uid(tombstone.table_name, tombstone.row_id)
+        row = session.query(model).filter_by(uid=uid).first()
+        if row is None:
+            continue
+        if row.time_updated is not None\
+                and _utc(row.time_updated) > _utc(tombstone.time_deleted):
+            report['conflicts'].append((model.__tablename__, row.id))
+            continue
+        affected = []
+        if model is Inventory:
+            affected = [row.id]
+        elif model is Interpreted:
+            affected = [row.inventory_id]
+        with stats.tracking(session, affected):
+            session.delete(row)
+        deleted += 1
+    report['deleted'][model.__tablename__] = deleted
+
+
+def sync(src_env, dst_env, engines=engines):
+    """Transfer the rows changed in src_env since the last run to dst_env
+
+    Cursors are stored in the destination database (``cursor`` table), one per
+    source env and table; the first run transfers everything. Run the function
+    twice with swapped arguments for a two way synchronization
+
+    Args:
+        src_env (str): Source env (database), as defined in the .idb file
+        dst_env (str): Destination env
+        engines (dict): Engines of the envs, see ``idb.db.engines``
+
+    Returns:
+        dict: Report with keys ``updated`` and ``deleted`` (number of rows per
+            table) and ``conflicts`` (list of (table, id) tuples of destination
+            rows kept because they were more recent)
+    """
+    report = {'updated': {}, 'deleted': {}, 'conflicts': []}
+    # Reference tables, copied in full
+    for model in REFERENCE_TABLES:
+        with session_scope(env=src_env, engines=engines) as session:
+            rows = session.query(model).all()
+            session.expunge_all()
+        with session_scope(env=dst_env, engines=engines) as session:
+            for row in rows:
+                session.merge(row)
+    # Change tracked tables
+    changes = {}
+    for env in (src_env, dst_env):
+        with session_scope(env=env, engines=engines) as session:
+            session.use_primary()
+            for model in TRACKED_TABLES:
+                _backfill_uids(session, model)
+    with session_scope(env=dst_env, engines=engines) as session:
+        cursors = {model: _get_cursor(session, 'sync:%s:%s' % (src_env, model.__tablename__))
+                   for model in TRACKED_TABLES}
+    with session_scope(env=src_env, engines=engines) as session:
+        run_start = _utc(session.query(func.now()).scalar())
+        for model in TRACKED_TABLES:
+            changes[model] = _read_changes(session, model, cursors[model])
+    with session_scope(env=dst_env, engines=engines) as session:
+        session.use_primary()
+        for model in TRACKED_TABLES:
+            _apply_rows(session, model, changes[model][0], changes[model][2],
+                        report)
+        for model in reversed(TRACKED_TABLES):
+            _apply_deletes(session, model, changes[model][1], report)
+        _reset_sequences(session, REFERENCE_TABLES + TRACKED_TABLES)
+        for model in TRACKED_TABLES:
+            _set_cursor(session, 'sync:%s:%s' % (src_env, model.__tablename__),
+                        run_start)
+    return report
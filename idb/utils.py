@@ -51,3 +51,43 @@ def camelify_feature(feature):
                              feature['properties'].items()}
     return feature
 
+
+
+def hilbert_key(lon, lat, order=24):
+    """Position of a point along a Hilbert curve covering the whole globe
+
+    Points close to each other usually have close keys; sorting records by key
+    therefore stores spatially close records close to each other
+
+    Args:
+        lon (float): Longitude, in degrees
+        lat (float): Latitude, in degrees
+        order (int): Order of the curve, the globe is divided in a grid of
+            2**order by 2**order cells (about 2 m at the equator for 24)
+
+    Returns:
+        int: The key, between 0 and 4**order - 1
+
+    Examples:
+        >>> hilbert_key(-180, -90, order=1)
+        0
+        >>> hilbert_key(180, -90, order=1)
+        3
+    """
+    n = 2 ** order
+    x = min(int((lon + 180.) / 360. * n), n - 1)
+    y = min(int((lat + 90.) / 180. * n), n - 1)
+    key = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        key += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s //= 2
+    return key
@@ -28,7 +28,12 @@ setup(name='idb',
           'shapely',
           'fiona',
           'jsonschema',
+          'numpy',
           'psycopg2-binary'],
       scripts=['idb/scripts/db_init.py',
                'idb/scripts/copy_db.py',
-               'idb/scripts/ingest_inventory.py'])
+               'idb/scripts/ingest_inventory.py',
+               'idb/scripts/rebuild_progress.py',
+               'idb/scripts/ingest_parallel.py',
+               'idb/scripts/sync_db.py',
+               'idb/scripts/qa_interpreted.py'])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Per call overhead of the inventory filter queries
+
+Compares the former query builder (Query rebuilt and recompiled at every call,
+literal geometry cast, features built from the ORM instances) with the public
+``idb.inventories`` (cached, parameterized statement) against the database of an
+env. Both run the same ST_DWithin predicate, so that the difference measured is
+the cost of query construction, compilation and feature building. The per call
+overhead is measured with calls returning no rows (LIMIT 0), as well as complete
+calls returning n samples.
+
+Usage: ./benchmark_filters.py -env main -n 1000
+"""
+
+import argparse
+import random
+import timeit
+
+from shapely.geometry import Point
+from sqlalchemy.sql.expression import func, cast
+from geoalchemy2.shape import from_shape
+
+from idb.db import session_scope
+from idb.models import Inventory
+from idb import inventories, GEOGRAPHY
+
+
+def legacy_query(session, lon, lat, radius, n_samples):
+    """Features as returned by idb.inventories before statement caching"""
+    geog = cast(from_shape(Point(lon, lat), srid=4326), GEOGRAPHY)
+    q = session.query(Inventory)\
+            .filter(Inventory.is_interpreted.is_(False))\
+            .filter(func.ST_DWithin(cast(Inventory.geom, GEOGRAPHY), geog, radius))\
+            .order_by(func.random())\
+            .limit(n_samples)
+    return [x.geojson for x in q]
+
+
+def cached_query(session, lon, lat, radius, n_samples):
+    return inventories(session, n_samples=n_samples,
+                       spatial_filter={'lon': lon, 'lat': lat,
+                                       'radius': radius})['features']
+
+
+def random_point(session):
+    return session.query(Inventory.geom.ST_X(), Inventory.geom.ST_Y())\
+            .order_by(func.random()).first()
+
+
+def main(env, n, radius, n_samples):
+    with session_scope(env=env) as session:
+        points = [random_point(session) for _ in range(20)]
+        points = [random.choice(points) for _ in range(n)]
+
+        def run(build, limit):
+            def calls():
+                for lon, lat in points:
+                    build(session, lon, lat, radius, limit)
+            return calls
+
+        # Warm up (first compilation of the cached statement, database caches)
+        run(cached_query, n_samples)()
+        run(legacy_query, n_samples)()
+        for name, limit in [('overhead', 0), ('execute', n_samples)]:
+            legacy = run(legacy_query, limit)
+            cached = run(cached_query, limit)
+            t_legacy = min(timeit.repeat(legacy, number=1, repeat=3)) / n
+            t_cached = min(timeit.repeat(cached, number=1, repeat=3)) / n
+            print('%-16s legacy: %8.3f ms/call  cached: %8.3f ms/call  (x%.1f)'
+                  % (name, t_legacy * 1000, t_cached * 1000, t_legacy / t_cached))
+
+
+if __name__ == '__main__':
+    epilog = """
+Benchmark the inventory filter queries against the database of an env
+
+Example usage:
+--------------
+./benchmark_filters.py -env main -n 1000 -r 100
+"""
+    parser = argparse.ArgumentParser(epilog=epilog,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-env', '--env',
+                        default='main',
+                        help='database to query')
+    parser.add_argument('-n', '--n',
+                        type=int,
+                        default=1000,
+                        help='Number of calls per measure')
+    parser.add_argument('-r', '--radius',
+                        type=float,
+                        default=100,
+                        help='Search radius in meters')
+    parser.add_argument('-s', '--n-samples',
+                        type=int,
+                        default=10,
+                        help='Number of samples returned per call')
+    parsed_args = parser.parse_args()
+    main(**vars(parsed_args))
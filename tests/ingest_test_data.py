@@ -3,7 +3,7 @@
 import fiona
 
 from idb.db import session_scope
-from idb import add_inventories
+from idb import add_inventories, stats
 from idb.models import Tile, Studyarea
 
 
@@ -26,3 +26,6 @@ with fiona.open(gpkg_file, layer='studyarea') as src:
 with session_scope() as session:
     session.add_all(studyarea_list)
 
+# Study areas are ingested last, refresh progress statistics
+with session_scope() as session:
+    stats.rebuild(session)
@@ -0,0 +1,49 @@
+import numpy as np
+from shapely.geometry import Point, Polygon, box
+
+from idb.chips import rasterize
+
+
+# 10 x 10 pixels of size 1; row r covers y in [9 - r, 10 - r], column c covers
+# x in [c, c + 1]
+BOUNDS = (0, 0, 10, 10)
+
+
+def test_square():
+    labels = rasterize([box(2, 2, 5, 5)], [1], BOUNDS, 1)
+    expected = np.zeros((10, 10), dtype=np.uint16)
+    expected[5:8, 2:5] = 1
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_hole():
+    polygon = Polygon(box(1, 1, 9, 9).exterior.coords,
+                      [box(4, 4, 6, 6).exterior.coords])
+    labels = rasterize([polygon], [3], BOUNDS, 1)
+    expected = np.zeros((10, 10), dtype=np.uint16)
+    expected[1:9, 1:9] = 3
+    expected[4:6, 4:6] = 0
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_overlap_last_wins():
+    labels = rasterize([box(1, 1, 5, 5), box(3, 3, 7, 7)], [1, 2], BOUNDS, 1)
+    expected = np.zeros((10, 10), dtype=np.uint16)
+    expected[5:9, 1:5] = 1
+    expected[3:7, 3:7] = 2
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_partly_outside():
+    labels = rasterize([box(-3, -3, 2, 2), box(20, 20, 30, 30)], [1, 2], BOUNDS, 1)
+    expected = np.zeros((10, 10), dtype=np.uint16)
+    expected[8:10, 0:2] = 1
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_pixel_centers():
+    polygon = Polygon([(0.3, 0.2), (9.1, 1.7), (6.2, 9.6), (3.3, 4.1), (1.2, 8.8)])
+    labels = rasterize([polygon], [1], BOUNDS, 0.5)
+    expected = np.array([[polygon.contains(Point(0.25 + 0.5 * c, 9.75 - 0.5 * r))
+                          for c in range(20)] for r in range(20)])
+    np.testing.assert_array_equal(labels.astype(bool), expected)
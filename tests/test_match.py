@@ -0,0 +1,23 @@
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from idb import _match_query
+
+
+def pg_session():
+    engine = create_engine('postgresql://', strategy='mock',
+                           executor=lambda *args, **kwargs: None)
+    return Session(bind=engine)
+
+
+def test_pg_lateral_compiles():
+    query = _match_query(pg_session(), interpreted_ids=[1, 2], same_species=True)
+    sql = str(query.statement.compile(dialect=postgresql.dialect()))
+    assert 'LEFT OUTER JOIN LATERAL' in sql
+    assert '<->' in sql
+    assert 'LIMIT' in sql
+    # Correlated to the outer interpreted table, not repeated in the subquery
+    nearest = sql[sql.index('LATERAL'):]
+    assert 'FROM inventory' in nearest
+    assert 'FROM inventory, interpreted' not in nearest
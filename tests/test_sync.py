@@ -0,0 +1,73 @@
+import datetime as dt
+
+from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+
+from idb import sync
+
+
+Base = declarative_base()
+
+
+class Row(Base):
+    """Minimal change tracked table (no geometry, runs on plain sqlite)"""
+    __tablename__ = 'row'
+    id = Column(Integer, primary_key=True)
+    uid = Column(String(36), unique=True)
+    name = Column(String)
+    time_updated = Column(DateTime)
+
+
+T0 = dt.datetime(2020, 1, 1)
+T1 = dt.datetime(2020, 1, 2)
+
+
+def session_with(rows):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = Session(bind=engine)
+    session.add_all([Row(**x) for x in rows])
+    session.commit()
+    return session
+
+
+def transfer(src, dst):
+    """Read all rows of src as sync does (loaded then expunged), write to dst"""
+    rows = src.query(Row).all()
+    src.expunge_all()
+    report = {'updated': {}, 'deleted': {}, 'conflicts': []}
+    sync._apply_rows(dst, Row, rows, {}, report)
+    dst.commit()
+    return {x.uid: (x.id, x.name) for x in dst.query(Row)}
+
+
+def test_diverging_ids():
+    # Both envs created rows independently, ids collide or differ
+    src = session_with([{'id': 1, 'uid': 'new', 'name': 'src new', 'time_updated': T0},
+                        {'id': 5, 'uid': 'b', 'name': 'b edited', 'time_updated': T1}])
+    dst = session_with([{'id': 1, 'uid': 'a', 'name': 'dst only', 'time_updated': T0},
+                        {'id': 5, 'uid': 'd', 'name': 'dst other', 'time_updated': T0},
+                        {'id': 9, 'uid': 'b', 'name': 'b', 'time_updated': T0}])
+    rows = transfer(src, dst)
+    assert rows['a'] == (1, 'dst only')
+    assert rows['d'] == (5, 'dst other')
+    assert rows['b'] == (9, 'b edited')
+    assert rows['new'][1] == 'src new'
+    assert rows['new'][0] not in (1, 5, 9)
+
+
+def test_diverging_ids_reverse():
+    # Same situation, synchronized in the other direction
+    src = session_with([{'id': 1, 'uid': 'a', 'name': 'dst only', 'time_updated': T0},
+                        {'id': 5, 'uid': 'd', 'name': 'dst other', 'time_updated': T0},
+                        {'id': 9, 'uid': 'b', 'name': 'b', 'time_updated': T0}])
+    dst = session_with([{'id': 1, 'uid': 'new', 'name': 'src new', 'time_updated': T0},
+                        {'id': 5, 'uid': 'b', 'name': 'b edited', 'time_updated': T1}])
+    rows = transfer(src, dst)
+    assert rows['new'] == (1, 'src new')
+    # Destination row is more recent, kept
+    assert rows['b'] == (5, 'b edited')
+    assert rows['a'][1] == 'dst only' and rows['a'][0] not in (1, 5)
+    assert rows['d'][1] == 'dst other' and rows['d'][0] not in (1, 5)
+    assert len(rows) == 4